@@ -1,5 +1,7 @@
 # pylint: disable=invalid-name,redefined-builtin
 import asyncio
+import collections
+import time
 import aiohttp
 
 from .etree import ElementTree
@@ -10,12 +12,28 @@ class NotFound(Exception):
 
 
 class JSS(object):
-    def __init__(self, url, username, password):
+    # GET latencies the hedge percentile is taken over, and how many must
+    # be seen before any GET is hedged
+    hedge_window = 500
+    hedge_warmup = 20
+
+    def __init__(self, url, username, password, hedge_percentile=None,
+                 hedge_budget=0.05):
+        """With hedge_percentile (e.g. 0.95) a GET that is slower than that
+        percentile of the GETs so far gets a second copy and the first
+        response wins, as long as hedges stay under hedge_budget of all
+        GETs sent
+        """
         self.url = url
         self.username = username
         self.password = password
         self.auth = aiohttp.BasicAuth(username, password)
         self.session = aiohttp.ClientSession(loop=asyncio.get_event_loop())
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self._latencies = collections.deque(maxlen=self.hedge_window)
+        self._gets = 0
+        self._hedges = 0
 
     def __del__(self):
         self.session.close()
@@ -24,21 +42,52 @@ class JSS(object):
         base_url = self.url + f'/JSSResource/{endpoint}'
         if id:
             url = base_url + f'/id/{id}'
-            async with self.session.get(url, auth=self.auth) as resp:
-                if resp.status != 200:
-                    raise NotFound
-                return await resp.text()
         elif name:
             url = base_url + f'/name/{name}'
-            async with self.session.get(url, auth=self.auth) as resp:
-                if resp.status != 200:
-                    raise NotFound
-                return await resp.text()
         else:
-            async with self.session.get(base_url, auth=self.auth) as resp:
-                if resp.status != 200:
-                    raise NotFound
-                return await resp.text()
+            url = base_url
+        if self.hedge_percentile is None:
+            return await self._get(url)
+        return await self._hedged_get(url)
+
+    async def _get(self, url):
+        async with self.session.get(url, auth=self.auth) as resp:
+            if resp.status != 200:
+                raise NotFound
+            return await resp.text()
+
+    def _hedge_delay(self):
+        self._gets += 1
+        if len(self._latencies) < self.hedge_warmup:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(self.hedge_percentile * len(latencies)))]
+
+    async def _hedged_get(self, url):
+        started = time.monotonic()
+        delay = self._hedge_delay()
+        copies = [asyncio.ensure_future(self._get(url))]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(copies, timeout=delay)
+                if not done and self._hedges < self.hedge_budget * self._gets:
+                    self._hedges += 1
+                    copies.append(asyncio.ensure_future(self._get(url)))
+            pending = copies
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                answered = [c for c in done if c.exception() is None]
+                if answered or not pending:
+                    break
+            if not answered:
+                return copies[0].result()
+            self._latencies.append(time.monotonic() - started)
+            return answered[0].result()
+        finally:
+            for copy in copies:
+                copy.cancel()
 
     async def _post_endpoint(self, endpoint, jss_object):
         base_url = self.url + f'/JSSResource/{endpoint}/name'
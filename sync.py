@@ -2,7 +2,21 @@
 # pylint: disable=missing-docstring,invalid-name
 import warnings
 import os
+import time
+import re
+import copy
+import json
+import hashlib
+import random
+import functools
+import collections
+import difflib
+from xml.dom import minidom
+import concurrent.futures
+import email.utils
+import datetime
 from os.path import dirname, join, realpath
+from urllib.parse import quote
 import sys
 import xml.etree.ElementTree as ET
 import getpass
@@ -11,511 +25,3185 @@ import logging
 import asyncio
 import async_timeout
 import aiohttp
+from aiohttp import web
 import uvloop
 import configparser
-import requests
-import configparser
-import requests
+import subprocess
+import signal
+import socket
+import shlex
+import struct
+import hmac
+import ctypes
+import ctypes.util
+
+LOG = logging.getLogger("git2jss")
+
+# The Jenkins file will contain a list of changes scripts and eas
+# in $scripts and $eas.
+# Use this variable to add a Slack emoji in front of each item if
+# you use a post-build action for a Slack custom message
+SLACK_EMOJI = ":white_check_mark: "
+SUPPORTED_SCRIPT_EXTENSIONS = ("sh", "py", "pl", "swift", "rb")
+SUPPORTED_EA_EXTENSIONS = ("sh", "py", "pl", "swift", "rb")
+# Category names that mean no category at all and are never created
+NO_CATEGORY = ("None", "No category assigned")
+# Elements the JSS adds or derives on its own; download.py strips them too
+SERVER_ONLY_ELEMENTS = ("id", "script_contents_encoded", "filename")
+SCRIPT_ELEMENTS = ("script_contents", "input_type/script")
+# Responses worth another attempt; 429 and 503 may carry a Retry-After
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# One object folder the git diff touched: status is A, M, D or R and
+# old_folder is the folder an R was renamed from
+Change = collections.namedtuple("Change", "kind folder status old_folder")
+# Tree of a commit without files, to diff the first commit of a repo
+EMPTY_TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+
+# https://github.com/lazymutt/Jamf-Pro-API-Sampler/blob/5f8efa92911271248f527e70bd682db79bc600f2/jamf_duplicate_detection.py#L99
+class TokenManager(object):
+    """Hands out the Jamf Pro API bearer token to every upload task. The
+    token is renewed through keep-alive ahead of its expiry, concurrent
+    renewals share one request and it is invalidated when the sync ends.
+    With cache_path set the token is kept on disk between runs instead
+    """
+
+    def __init__(
+        self, url, username, password, refresh_margin, timeout, cache_path=None
+    ):
+        self.url = url
+        self.auth = aiohttp.BasicAuth(username, password)
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        self.cache_path = cache_path
+        self.token = None
+        self.expires = 0.0
+        self.lock = asyncio.Lock()
+        if cache_path:
+            self.load()
+
+    async def get(self, session):
+        if self.token is None or self.expires - time.time() < self.refresh_margin:
+            await self.refresh(session, self.token)
+        return self.token
+
+    async def refresh(self, session, stale):
+        """Renews the token unless another task already replaced stale"""
+        async with self.lock:
+            if self.token != stale:
+                return
+            if self.token is not None and self.expires > time.time():
+                resp = await self.post(
+                    session, "/api/v1/auth/keep-alive", headers=self.bearer()
+                )
+                if resp is not None:
+                    return self.store(resp)
+            resp = await self.post(session, "/api/v1/auth/token", auth=self.auth)
+            if resp is None:
+                raise RuntimeError("Unable to get an API token from %s" % self.url)
+            self.store(resp)
+
+    async def invalidate(self, session):
+        if self.token is None or self.cache_path:
+            return
+        await self.post(session, "/api/v1/auth/invalidate-token", headers=self.bearer())
+        self.token = None
+
+    async def post(self, session, endpoint, **kwargs):
+        async with async_timeout.timeout(self.timeout):
+            async with session.post(self.url + endpoint, **kwargs) as resp:
+                if resp.status in (200, 204):
+                    return await resp.json() if resp.status == 200 else {}
+        return None
+
+    def bearer(self):
+        return {"Accept": "*/*", "Authorization": "Bearer " + self.token}
+
+    def store(self, resp):
+        self.token = resp["token"]
+        try:
+            self.expires = (
+                datetime.datetime.strptime(resp["expires"][:19], "%Y-%m-%dT%H:%M:%S")
+                .replace(tzinfo=datetime.timezone.utc)
+                .timestamp()
+            )
+        except (KeyError, ValueError):
+            # Tokens are valid for 30 minutes unless configured otherwise
+            self.expires = time.time() + 30 * 60
+        if self.cache_path:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        if cached.get("auth") == self.auth_digest():
+            self.token, self.expires = cached["token"], cached["expires"]
+
+    def save(self):
+        os.makedirs(dirname(self.cache_path), exist_ok=True)
+        fd = os.open(self.cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {
+                    "auth": self.auth_digest(),
+                    "token": self.token,
+                    "expires": self.expires,
+                },
+                f,
+            )
+
+    def auth_digest(self):
+        """Ties a cached token to the credentials it was issued for"""
+        return hashlib.sha256(
+            (self.url + "\0" + self.auth.encode()).encode("utf-8")
+        ).hexdigest()
+
+
+class SyncContext(object):
+    """Everything one sync engine works with in place of module globals:
+    the options in args, the repo at sync_path, the targets and the state
+    of the run in progress. Functions get it passed in or reach it through
+    target.ctx, so any number of contexts can be used in one process
+    """
+
+    def __init__(self, sync_path, args=None, **options):
+        if args is None:
+            args = build_parser().parse_args([])
+        for option, value in options.items():
+            if not hasattr(args, option):
+                raise TypeError("Unknown sync option: %s" % option)
+            setattr(args, option, value)
+        self.args = args
+        self.sync_path = sync_path
+        # Every JSS the run syncs to, see Target
+        self.targets = []
+        # Thread pool for file, git and XML work that would otherwise block
+        # the event loop and stall every request in flight
+        self.executor = None
+        # folder type -> {folder: entry} of everything under scripts/ and
+        # extension_attributes/, see scan_folder(). Loaded by the first run
+        # and kept up to date by the ones after it
+        self.manifest = {}
+        self.reset()
+
+    def reset(self):
+        """Clears what one run learns, for the next run to start afresh"""
+        # (kind, folder) of the working tree to sync in place of what
+        # changed in git, see Syncer.run()
+        self.folders = None
+        # (type, folder) -> [future of what was read from the folder,
+        # targets still to use it], so each folder is read once however
+        # many targets
+        self.reads = {}
+        # Commit HEAD pointed at when the changes were looked up, recorded
+        # as the watermark once the run succeeded
+        self.sync_commit = None
+        # Folders to upload, for the jenkins file
+        self.changed_scripts = []
+        self.changed_ext_attrs = []
+        for target in self.targets:
+            target.reset()
+
+    @property
+    def update_all(self):
+        """Whether the run looks at every folder, which --update_all and
+        --drift ask for unless the run was given its folders
+        """
+        return (self.args.update_all or self.args.drift) and self.folders is None
+
+    def results(self):
+        """What the run synced and what failed per target"""
+        return {
+            "shard": list(self.args.shard or (1, 1)),
+            "commit": self.sync_commit,
+            "scripts": self.changed_scripts,
+            "extension_attributes": self.changed_ext_attrs,
+            "targets": {
+                target.name: dict(
+                    run_stats([target]), failures=target.failed, drift=target.drift
+                )
+                for target in self.targets
+            },
+        }
+
+
+class Target(object):
+    """One JSS the repo is synced to, with its own credentials, API token
+    and adaptive limiter, and everything the run learns about it: the
+    remote indexes and categories, the ledger, the changes since its last
+    synced commit and what went wrong. All targets of a run share one scan
+    of the repo and each folder is read only once
+    """
+
+    def __init__(
+        self, ctx, url, username, password, limit, min_limit, max_limit, nodes=()
+    ):
+        args = ctx.args
+        self.ctx = ctx
+        self.url = url
+        self.username = username
+        self.password = password
+        # Filesystem safe name of the server for its state files
+        self.name = re.sub(r"[^A-Za-z0-9.-]+", "_", url.split("://")[-1]).strip("_")
+        self.limiter = AdaptiveLimiter(
+            limit, min_limit, max_limit, args.latency_tolerance
+        )
+        # url first, so it is the primary that --pin_writes sends writes to
+        self.nodes = NodePool(
+            [url] + [n for n in nodes if n != url],
+            args.pin_writes,
+            args.eject_seconds,
+            args.health_interval,
+        )
+        self.hedger = None
+        if args.hedge_percentile is not None:
+            self.hedger = Hedger(args.hedge_percentile, args.hedge_budget)
+        self.tokens = TokenManager(
+            url,
+            username,
+            password,
+            args.token_refresh,
+            args.timeout,
+            self.state_path("token") if args.token_cache else None,
+        )
+        self.reset()
+
+    def reset(self):
+        self.categories = set()
+        # category name -> future of its creation, see ensure_category()
+        self.category_creates = {}
+        # name -> id indexes of the remote objects, fetched once per run so
+        # each upsert is a single PUT by id or POST
+        self.script_index = {}
+        self.ea_index = {}
+        # (resource, id) -> future of the remote XML, so a remote template
+        # is never fetched twice in the same run
+        self.remote_templates = {}
+        # resource -> {name: digest} of the payloads last pushed
+        self.ledger = {}
+        # Append-only file of every object the JSS confirmed in this run,
+        # see open_journal()
+        self.journal = None
+        # (kind, folder) -> Change of every object folder the git diff
+        # touched, diffed from diff_base where deleted objects are looked up
+        self.changes = {}
+        self.diff_base = None
+        # (action, type label, name, diff lines) of every object --plan
+        # looked at
+        self.plan = []
+        # (state, type label, name) of every object --drift compared, see
+        # drift_target()
+        self.drift = []
+        # (type, name, reason) of every object that still failed after
+        # retrying
+        self.failed = []
+        # Counters of the run and the seconds each object took from being
+        # read to being sent, written out by --stats_file
+        self.stats = collections.Counter()
+        self.latencies = []
+
+    def state_path(self, kind, suffix=""):
+        """One state file of each kind per target server, named after it"""
+        return join(self.ctx.args.state_dir, kind, self.name + suffix + ".json")
+
+    def indexes(self):
+        return (
+            ("scripts", self.script_index),
+            ("computerextensionattributes", self.ea_index),
+        )
+
+    def index(self, resource):
+        return dict(self.indexes())[resource]
+
+    def log(self, message):
+        """Prints message, naming the target when there are several"""
+        if len(self.ctx.targets) > 1:
+            message = "%s: %s" % (self.name, message)
+        print(message)
+
+    def wants(self, kind, folder):
+        """Whether kind/folder is uploaded to this target in this run"""
+        if self.ctx.update_all:
+            return True
+        change = self.changes.get((kind, folder))
+        return change is not None and change.status != "D"
+
+
+async def git(ctx, *git_args):
+    """Runs git in the repo at sync_path and returns its stdout, raising
+    CalledProcessError when it fails
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "git",
+        *git_args,
+        cwd=ctx.sync_path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out, err = await proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(
+            proc.returncode, ["git"] + list(git_args), out, err
+        )
+    return out
+
+
+async def rev_parse(ctx, rev):
+    """Full hash of the commit rev points to, or None"""
+    try:
+        out = await git(ctx, "rev-parse", "-q", "--verify", rev + "^{commit}")
+    except subprocess.CalledProcessError:
+        return None
+    return out.decode().strip()
+
+
+async def check_for_changes(target):
+    """Looks for files that were changed between the current commit and
+    the last commit so we don't upload everything on every run
+      the last commit synced to target is used when there is one,
+        see watermark_ref()
+      --jenkins will utilize $GIT_PREVIOUS_COMMIT and $GIT_COMMIT
+        environmental variables
+      --update_all can be invoked to upload all scripts and
+        extension attributes
+    The result is kept per object folder in target.changes, the folders
+    to upload are added to the lists of the jenkins file
+    """
+    ctx = target.ctx
+    if ctx.folders is not None:
+        # The folders the agent was told about as they are in the working
+        # tree, deleted ones named as at HEAD. A folder in neither is a
+        # typo rather than a deletion. No commit is synced as a whole, so
+        # the watermark stays where it is
+        target.diff_base = "HEAD"
+        paths = ["%s/%s" % key for key in ctx.folders]
+        out = await git(ctx, "ls-tree", "-z", "--name-only", "HEAD", "--", *paths)
+        tracked = set(out.decode("utf-8", "surrogateescape").split("\0"))
+        records = [
+            ("M", path + "/", None)
+            for path in paths
+            if path in tracked or os.path.isdir(join(ctx.sync_path, path))
+        ]
+    else:
+        records = await diff_records(target)
+    changes = await run_blocking(ctx, folder_changes, ctx.sync_path, records)
+    target.changes = {
+        key: change
+        for key, change in changes.items()
+        if in_shard(ctx, change.kind, change.folder)
+    }
+    for change in target.changes.values():
+        changed = changed_folders(ctx, change.kind)
+        if change.status != "D" and change.folder not in changed:
+            changed.append(change.folder)
+
+
+async def diff_records(target):
+    """The git diff of check_for_changes(), split by parse_name_status()"""
+    ctx = target.ctx
+    ctx.sync_commit = await rev_parse(ctx, "HEAD")
+    watermark = await rev_parse(ctx, watermark_ref(target))
+    # Everything since the last successful sync, however many pushes
+    # or builds ago that was
+    if watermark and ctx.sync_commit:
+        print("%s: changes since last synced commit %s" % (target.name, watermark[:12]))
+        base, head = watermark, ctx.sync_commit
+
+    # This line will work with the environmental variables in Jenkins
+    elif ctx.args.jenkins and os.environ.get("GIT_PREVIOUS_COMMIT"):
+        base = os.environ["GIT_PREVIOUS_COMMIT"]
+        head = os.environ.get("GIT_COMMIT", "HEAD")
+
+    # Compare the last two commits to determine the list of files that
+    # were changed, the first commit of a repo against the empty tree
+    else:
+        base = await rev_parse(ctx, "HEAD~1") or EMPTY_TREE
+        head = "HEAD"
+
+    target.diff_base = base
+    out = await git(
+        ctx,
+        "diff",
+        "--name-status",
+        "-z",
+        "-M",
+        "--relative",
+        base,
+        head,
+        "--",
+        *[rtype.folder for rtype in RESOURCE_TYPES],
+    )
+    return parse_name_status(out)
+
+
+def parse_name_status(out):
+    """Splits the output of git diff --name-status -z into
+    (status letter, path, old path) with old path only set on renames
+    and copies
+    """
+    fields = out.decode("utf-8", "surrogateescape").split("\0")
+    records = []
+    i = 0
+    while i + 1 < len(fields):
+        status = fields[i][:1]
+        if status in "RC":
+            records.append((status, fields[i + 2], fields[i + 1]))
+            i += 3
+        else:
+            records.append((status, fields[i + 1], None))
+            i += 2
+    return records
+
+
+def object_folder(path):
+    """(kind, folder) of a path like scripts/<folder>/<file>, or None for
+    anything that isn't inside an object folder
+    """
+    parts = path.split("/")
+    if len(parts) < 3 or parts[0] not in [r.folder for r in RESOURCE_TYPES]:
+        return None
+    return parts[0], parts[1]
+
+
+def folder_changes(sync_path, records):
+    """Folds the per-file records of the diff into one Change per object
+    folder. A folder is deleted when it is gone from the checkout and
+    renamed when its files moved to another folder of the same kind that
+    took its place
+    """
+    files = collections.defaultdict(set)
+    renamed_from = {}
+    for status, path, old_path in records:
+        new = object_folder(path)
+        old = object_folder(old_path) if old_path else None
+        if status == "R" and old and new and old != new and old[0] == new[0]:
+            renamed_from[new] = old[1]
+            files[new].add("R")
+            files[old].add("R")
+            continue
+        if old and status == "R":
+            files[old].add("D")
+            status = "A"
+        if new:
+            files[new].add(status)
+    changes = {}
+    sources = {(kind, old) for (kind, _), old in renamed_from.items()}
+    for (kind, folder), statuses in sorted(files.items()):
+        if not os.path.isdir(join(sync_path, kind, folder)):
+            if (kind, folder) not in sources:
+                changes[kind, folder] = Change(kind, folder, "D", None)
+        elif (kind, folder) in renamed_from and not os.path.isdir(
+            join(sync_path, kind, renamed_from[kind, folder])
+        ):
+            changes[kind, folder] = Change(
+                kind, folder, "R", renamed_from[kind, folder]
+            )
+        elif statuses == {"A"}:
+            changes[kind, folder] = Change(kind, folder, "A", None)
+        else:
+            changes[kind, folder] = Change(kind, folder, "M", None)
+    return changes
+
+
+def watermark_ref(target):
+    """The last commit synced to a server is kept as a ref of the repo, so
+    it follows the checkout and is never garbage collected. Each shard
+    keeps its own, as it only syncs its own part of the repo
+    """
+    return "refs/git2jss/" + target.name + shard_suffix(target.ctx)
+
+
+def shard_spec(value):
+    """Parses the i/N of --shard into (i, N), counting shards from 1"""
+    try:
+        index, count = [int(n) for n in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, not %r" % value)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            "shard %d doesn't exist in %d" % (index, count)
+        )
+    return index, count
+
+
+def webhook_spec(value):
+    """Parses the [host:]port of --webhook into (host, port), host None
+    for every interface
+    """
+    host, _, port = value.rpartition(":")
+    try:
+        return host or None, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected [host:]port, not %r" % value)
+
+
+def in_shard(ctx, kind, folder):
+    """Whether kind/folder belongs to this run's --shard. Folders are
+    split by a hash of their path, which doesn't change from run to run or
+    machine to machine
+    """
+    args = ctx.args
+    if not args.shard:
+        return True
+    index, count = args.shard
+    digest = hashlib.sha1(("%s/%s" % (kind, folder)).encode("utf-8")).hexdigest()
+    return int(digest, 16) % count == index - 1
+
+
+def shard_suffix(ctx):
+    args = ctx.args
+    if not args.shard:
+        return ""
+    return ".shard-%d-of-%d" % args.shard
+
+
+async def save_watermark(target):
+    """Moves the watermark to the commit this run synced. Only called
+    when every object made it, so failed ones are picked up next time
+    """
+    ctx = target.ctx
+    if ctx.sync_commit:
+        await git(ctx, "update-ref", watermark_ref(target), ctx.sync_commit)
+
+
+def write_jenkins_file(changed_ext_attrs, changed_scripts):
+    """Write changed_ext_attrs and changed_scripts to jenkins file.
+    $eas will contains the changed extension attributes,
+    $scripts will contains the changed scripts
+    If there are no changes, the variable will be set to 'None'
+    """
+
+    if not changed_ext_attrs:
+        contents = "eas=" + "None"
+    else:
+        contents = "eas=" + SLACK_EMOJI + changed_ext_attrs[0] + "\\n" + "\\"
+        for changed_ext_attr in changed_ext_attrs[1:]:
+            contents = contents + "\n" + SLACK_EMOJI + changed_ext_attr + "\\n" + "\\"
+
+    if not changed_scripts:
+        contents = contents.rstrip("\\") + "\n" + "scripts=" + "None"
+
+    else:
+        contents = (
+            contents.rstrip("\\")
+            + "\n"
+            + "scripts="
+            + SLACK_EMOJI
+            + changed_scripts[0]
+            + "\\n"
+            + "\\"
+        )
+        for changed_script in changed_scripts[1:]:
+            contents = contents + "\n" + SLACK_EMOJI + changed_script + "\\n" + "\\"
+
+    with open("jenkins.properties", "w") as f:
+        f.write(contents)
+
+
+class AdaptiveLimiter(object):
+    """Drop-in for the old BoundedSemaphore that adjusts how many requests
+    may be in flight with AIMD: every successful request adds 1/limit, an
+    error or a smoothed latency above latency_tolerance times the best seen
+    so far multiplies the limit by decrease, at most once per round trip.
+    The limit stays between floor and ceiling
+    """
+
+    decrease = 0.7
+    alpha = 0.2  # Weight of the newest sample in the smoothed latency
+
+    def __init__(self, initial, floor, ceiling, latency_tolerance):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.limit = float(min(max(initial, self.floor), self.ceiling))
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.latency = None
+        self.baseline = None
+        self.last_decrease = 0.0
+        self.lowest = self.highest = int(self.limit)
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            while self.in_flight >= int(self.limit):
+                await self.condition.wait()
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify(max(1, int(self.limit) - self.in_flight))
+
+    def observe(self, latency, ok):
+        """Feeds the outcome of one request back into the limit"""
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+        if self.baseline is None or self.latency < self.baseline:
+            self.baseline = self.latency
+        previous = int(self.limit)
+        now = time.monotonic()
+        congested = not ok or self.latency > self.baseline * self.latency_tolerance
+        if congested:
+            if now - self.last_decrease > self.latency:
+                self.limit = max(self.floor, self.limit * self.decrease)
+                self.last_decrease = now
+        else:
+            self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+        if int(self.limit) != previous:
+            LOG.debug(
+                "Concurrency %d -> %d (latency %.3fs, baseline %.3fs)",
+                previous,
+                int(self.limit),
+                self.latency,
+                self.baseline,
+            )
+            self.lowest = min(self.lowest, int(self.limit))
+            self.highest = max(self.highest, int(self.limit))
+
+    def report(self):
+        LOG.info(
+            "Concurrency settled at %d (ranged %d-%d, floor %d, ceiling %d)",
+            int(self.limit),
+            self.lowest,
+            self.highest,
+            self.floor,
+            self.ceiling,
+        )
+
+
+class Node(object):
+    """One node of a clustered JSS"""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.ejected_until = 0.0
+
+
+class NodePool(object):
+    """Spreads the requests of one target over the nodes of its cluster,
+    each to the healthy node with the fewest outstanding requests. A node
+    that times out, fails to connect or answers 5xx is ejected for
+    eject_seconds, and the health check started by start() lets it back
+    in as soon as it answers again, or ejects a node before a request has
+    to fail. With pin_writes everything but GETs goes to the primary
+    """
+
+    health_path = "/healthCheck.html"
+
+    def __init__(self, urls, pin_writes, eject_seconds, health_interval):
+        self.nodes = [Node(url) for url in urls]
+        self.pin_writes = pin_writes
+        self.eject_seconds = eject_seconds
+        self.health_interval = health_interval
+        self.task = None
+
+    def pick(self, method):
+        if self.pin_writes and method != "GET":
+            return self.nodes[0]
+        now = time.monotonic()
+        # With every node ejected, the least loaded is still the best bet
+        healthy = [n for n in self.nodes if n.ejected_until <= now] or self.nodes
+        return min(healthy, key=lambda n: n.outstanding)
+
+    def eject(self, node, reason):
+        if len(self.nodes) < 2:
+            return
+        if node.ejected_until <= time.monotonic():
+            LOG.warning(
+                "Ejecting %s for %ds (%s)", node.url, self.eject_seconds, reason
+            )
+        node.ejected_until = time.monotonic() + self.eject_seconds
+
+    def start(self, session):
+        if len(self.nodes) > 1:
+            self.task = asyncio.ensure_future(self.run(session))
+
+    async def run(self, session):
+        while True:
+            await asyncio.gather(*[self.check(session, n) for n in self.nodes])
+            await asyncio.sleep(self.health_interval)
+
+    async def check(self, session, node):
+        try:
+            async with async_timeout.timeout(self.health_interval):
+                async with session.get(node.url + self.health_path) as resp:
+                    await resp.read()
+                    healthy = resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.eject(node, repr(e))
+            return
+        if not healthy:
+            self.eject(node, "health check %s" % resp.status)
+        elif node.ejected_until > time.monotonic():
+            LOG.warning("Readmitting %s", node.url)
+            node.ejected_until = 0.0
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if len(self.nodes) > 1:
+            LOG.info(
+                "Requests per node: %s",
+                ", ".join("%s %d" % (n.url, n.requests) for n in self.nodes),
+            )
+
+
+class Hedger(object):
+    """Decides when a GET to one target gets a second, hedged copy: once it
+    has been waiting longer than the given percentile of the GET latencies
+    seen so far in the run, and only while the hedges stay under budget, a
+    fraction of all GETs sent
+    """
+
+    window = 500  # Latest GET latencies the percentile is taken over
+    warmup = 20  # GETs answered before any is hedged
+
+    def __init__(self, fraction, budget):
+        self.fraction = fraction
+        self.budget = budget
+        self.latencies = collections.deque(maxlen=self.window)
+        self.sent = 0
+        self.hedged = 0
+
+    def delay(self):
+        """Seconds after which a GET sent now is hedged, None for never"""
+        self.sent += 1
+        if len(self.latencies) < self.warmup:
+            return None
+        return percentile(self.latencies, self.fraction)
+
+    def allow(self):
+        """Takes one hedge out of the budget, if there is one left"""
+        if self.hedged >= self.budget * self.sent:
+            return False
+        self.hedged += 1
+        return True
+
+    def observe(self, latency):
+        self.latencies.append(latency)
+
+
+async def run_blocking(ctx, func, *func_args):
+    """Runs func in the executor of ctx and waits for it without blocking
+    the loop
+    """
+    return await asyncio.get_event_loop().run_in_executor(
+        ctx.executor, functools.partial(func, *func_args)
+    )
+
+
+def read_file(path):
+    with open(path, "r") as f:
+        return f.read()
+
+
+def parse_xml_file(path):
+    return ET.parse(path).getroot()
+
+
+def print_template(template):
+    print(ET.tostring(template))
+
+
+class LoopLagMonitor(object):
+    """Measures how late the event loop wakes up from short sleeps, which
+    is how long something blocked it, and keeps the longest stall
+    """
+
+    interval = 0.05
+
+    def __init__(self):
+        self.longest = 0.0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.longest = max(self.longest, loop.time() - expected)
+
+    def stop(self):
+        self.task.cancel()
+        LOG.info("Longest event loop stall: %.3fs", self.longest)
+
+
+def jss_headers(token):
+    return {
+        "Accept": "application/xml",
+        "Content-Type": "application/xml",
+        "Authorization": "Bearer " + token,
+    }
+
+
+def backoff_delay(ctx, attempt):
+    """Capped exponential backoff with full jitter"""
+    args = ctx.args
+    return random.uniform(0, min(args.max_backoff, args.backoff * 2 ** attempt))
+
+
+def retry_after(resp):
+    """Returns the Retry-After of a 429/503 in seconds, or None"""
+    value = resp.headers.get("Retry-After")
+    if resp.status not in (429, 503) or not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, when.timestamp() - time.time())
+
+
+async def send_request(session, target, method, path, token, sent=None, **kwargs):
+    """One attempt of jss_request, holding a slot of the target's
+    AdaptiveLimiter. Returns (status, body, Retry-After)
+    """
+    async with target.limiter:
+        return await send_now(session, target, method, path, token, sent, **kwargs)
+
+
+async def send_now(session, target, method, path, token, sent=None, **kwargs):
+    """Sends one request to the node of the target that NodePool picks,
+    with its own timeout, and reports its latency and outcome to the
+    target's AdaptiveLimiter. The sent future, if any, gets the time the
+    request went out. Returns (status, body, Retry-After)
+    """
+    node = target.nodes.pick(method)
+    started = time.monotonic()
+    if sent is not None:
+        sent.set_result(started)
+    target.stats["requests"] += 1
+    node.requests += 1
+    node.outstanding += 1
+    try:
+        async with async_timeout.timeout(target.ctx.args.timeout):
+            async with session.request(
+                method, node.url + path, headers=jss_headers(token), **kwargs
+            ) as resp:
+                body = await resp.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        target.limiter.observe(time.monotonic() - started, ok=False)
+        target.nodes.eject(node, repr(e))
+        raise
+    finally:
+        node.outstanding -= 1
+    target.limiter.observe(
+        time.monotonic() - started, ok=resp.status not in RETRY_STATUSES
+    )
+    if resp.status >= 500:
+        target.nodes.eject(node, "HTTP %s" % resp.status)
+    return resp.status, body, retry_after(resp)
+
+
+async def send_hedged(session, target, path, token, **kwargs):
+    """A GET attempt that sends a second copy when the first is slower than
+    the target's Hedger allows, and returns whichever answers first. The
+    other copy is cancelled. GETs are idempotent, so a hedge only costs
+    the extra load the Hedger budgets for, and it goes out straight away
+    instead of queueing for a limiter slot behind the requests it is
+    meant to overtake
+    """
+    hedger = target.hedger
+    sent = asyncio.get_event_loop().create_future()
+    first = asyncio.ensure_future(
+        send_request(session, target, "GET", path, token, sent, **kwargs)
+    )
+    copies = [first]
+    try:
+        # Time spent waiting for a limiter slot isn't the server being slow,
+        # so the clock starts when the first copy goes out
+        await asyncio.wait([first, sent], return_when=asyncio.FIRST_COMPLETED)
+        wait = hedger.delay() if sent.done() else None
+        if wait is not None:
+            done, _ = await asyncio.wait(copies, timeout=wait)
+            if not done and hedger.allow():
+                target.stats["hedged"] += 1
+                copies.append(
+                    asyncio.ensure_future(
+                        send_now(session, target, "GET", path, token, **kwargs)
+                    )
+                )
+        # A copy that failed only loses if the other one answers
+        pending = copies
+        while True:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            answered = [task for task in done if task.exception() is None]
+            if answered or not pending:
+                break
+        if not answered:
+            return first.result()
+        if answered[0] is not first:
+            target.stats["hedges_won"] += 1
+        hedger.observe(time.monotonic() - sent.result())
+        return answered[0].result()
+    finally:
+        for task in copies:
+            task.cancel()
+
+
+async def jss_request(session, target, method, path, retries=None, **kwargs):
+    """Sends a request for path to target, retrying timeouts, connection
+    errors and RETRY_STATUSES up to retries times. The backoff in between
+    attempts holds no limiter slot, and with --hedge_percentile GETs may
+    be hedged, see send_hedged(). A 401 renews the token and is retried
+    once.
+    Returns (status, body) of the last response and raises the last error
+    if no response was received at all
+    """
+    if retries is None:
+        retries = target.ctx.args.retries
+    attempt = 0
+    reauthenticated = False
+    while True:
+        token = await target.tokens.get(session)
+        try:
+            if method == "GET" and target.hedger is not None:
+                status, body, delay = await send_hedged(
+                    session, target, path, token, **kwargs
+                )
+            else:
+                status, body, delay = await send_request(
+                    session, target, method, path, token, **kwargs
+                )
+            if status == 401 and not reauthenticated:
+                reauthenticated = True
+                await target.tokens.refresh(session, token)
+                continue
+            if status not in RETRY_STATUSES or attempt >= retries:
+                return status, body
+            reason = status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt >= retries:
+                raise
+            reason = repr(e)
+            delay = None
+        attempt += 1
+        if delay is None:
+            delay = backoff_delay(target.ctx, attempt)
+        LOG.debug("Retrying %s %s in %.1fs (%s)", method, path, delay, reason)
+        await asyncio.sleep(delay)
+
+
+async def run_stage(inbox, outbox, handler, workers, next_workers, target):
+    """Runs workers that take (resource type, folder, value) items from
+    inbox, pass them through handler and put the result into outbox in
+    place of value. A None result drops the item and an exception is
+    recorded against target, so one object can't stop the others. Each worker
+    stops at a None sentinel, after which next_workers sentinels are sent
+    on to the next stage
+    """
+
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is None:
+                return
+            rtype, folder, value = item
+            try:
+                result = await handler(rtype, folder, value)
+            except Exception as e:  # pylint: disable=broad-except
+                target.log("Error uploading %s: %s" % (rtype.label, folder))
+                print("Error: %r" % e)
+                target.failed.append((rtype.label, folder, repr(e)))
+                continue
+            if result is not None and outbox is not None:
+                await outbox.put((rtype, folder, result))
+
+    await asyncio.gather(*[worker() for _ in range(workers)])
+    for _ in range(next_workers):
+        await outbox.put(None)
+
+
+async def run_pipeline(folders, read, build, send, target):
+    """Uploads (resource type, folder) pairs to target through bounded
+    queues between the scan, read, build and send stages, so memory use
+    doesn't grow with the size of the repo and the first uploads start
+    while the scan is still going. Every target runs its own pipeline, so
+    a slow server only holds up its own send workers
+    """
+    args = target.ctx.args
+    reading, building, sending = [asyncio.Queue(args.queue_size) for _ in range(3)]
+    workers = target.limiter.ceiling
+    stages = [
+        asyncio.ensure_future(stage)
+        for stage in (
+            run_stage(
+                reading, building, read, args.io_workers, args.io_workers, target
+            ),
+            run_stage(building, sending, build, args.io_workers, workers, target),
+            run_stage(sending, None, send, workers, 0, target),
+        )
+    ]
+    try:
+        async for rtype, folder in folders:
+            await reading.put((rtype, folder, None))
+        for _ in range(args.io_workers):
+            await reading.put(None)
+        await asyncio.gather(*stages)
+    finally:
+        for stage in stages:
+            stage.cancel()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_stats(targets):
+    """Counters and latency percentiles of targets added up"""
+    stats = collections.Counter()
+    latencies = []
+    for target in targets:
+        stats.update(target.stats)
+        latencies.extend(target.latencies)
+    return {
+        "objects": len(latencies),
+        "uploaded": stats["uploaded"],
+        "unchanged": stats["unchanged"],
+        "renamed": stats["renamed"],
+        "deleted": stats["deleted"],
+        "failed": sum(len(target.failed) for target in targets),
+        "requests": stats["requests"],
+        "hedged": stats["hedged"],
+        "hedges_won": stats["hedges_won"],
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+    }
+
+
+def write_stats_file(ctx, path, elapsed):
+    """Writes the run's counters and per-object latencies as JSON for
+    tools/benchmark and other tooling, with a breakdown per target when
+    there are several
+    """
+    stats = run_stats(ctx.targets)
+    stats["elapsed"] = elapsed
+    if len(ctx.targets) > 1:
+        stats["targets"] = {target.name: run_stats([target]) for target in ctx.targets}
+    with open(path, "w") as f:
+        json.dump(stats, f, indent=1)
+
+
+def write_results_file(path, results):
+    """Writes the results of a run, see SyncContext.results(), for
+    merge_results() to combine the shards of a sync
+    """
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1)
+
+
+def merge_results(paths):
+    """Combines the result files of the shards of one sync into a single
+    report and jenkins file. Returns the exit status: 1 if any shard is
+    missing or any object failed
+    """
+    results = []
+    for path in paths:
+        with open(path, "r") as f:
+            results.append(json.load(f))
+    status = 0
+    shards = sorted(tuple(result["shard"]) for result in results)
+    count = shards[0][1]
+    if shards != [(i, count) for i in range(1, count + 1)]:
+        print("Expected one result for each of %d shards, got %s" % (count, shards))
+        status = 1
+    if len({result["commit"] for result in results}) > 1:
+        print("The shards synced different commits")
+        status = 1
+    changed_scripts = sorted({f for r in results for f in r["scripts"]})
+    changed_ext_attrs = sorted({f for r in results for f in r["extension_attributes"]})
+    write_jenkins_file(changed_ext_attrs, changed_scripts)
+    totals = collections.defaultdict(collections.Counter)
+    failures = collections.defaultdict(list)
+    for result in results:
+        for name, stats in result["targets"].items():
+            for key in ("uploaded", "unchanged", "renamed", "deleted"):
+                totals[name][key] += stats[key]
+            failures[name].extend(stats["failures"])
+    for name in sorted(totals):
+        print(
+            "%s: %d uploaded, %d unchanged, %d renamed, %d deleted, %d failed"
+            % (
+                name,
+                totals[name]["uploaded"],
+                totals[name]["unchanged"],
+                totals[name]["renamed"],
+                totals[name]["deleted"],
+                len(failures[name]),
+            )
+        )
+        for kind, obj, reason in sorted(failures[name]):
+            print("  %s %s: %s" % (kind, obj, reason))
+        if failures[name]:
+            status = 1
+    return status
+
+
+def print_failure_summary(ctx):
+    for target in ctx.targets:
+        if len(ctx.targets) > 1 and not (ctx.args.plan or ctx.args.drift):
+            stats = run_stats([target])
+            print(
+                "%s: %d uploaded, %d unchanged, %d renamed, %d deleted, %d failed"
+                % (
+                    target.name,
+                    stats["uploaded"],
+                    stats["unchanged"],
+                    stats["renamed"],
+                    stats["deleted"],
+                    stats["failed"],
+                )
+            )
+        if not target.failed:
+            continue
+        print("%d object(s) failed to sync to %s:" % (len(target.failed), target.name))
+        for kind, name, reason in sorted(target.failed):
+            print("  %s %s: %s" % (kind, name, reason))
+
+
+def manifest_path(ctx):
+    """The manifest cache belongs to the checkout, not to a server"""
+    checkout = hashlib.sha1(realpath(ctx.sync_path).encode("utf-8")).hexdigest()[:12]
+    return join(ctx.args.state_dir, "manifest", checkout + ".json")
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_folder(path, cached):
+    """Returns the manifest entry of one object folder. Like git's index,
+    the listing is reused while the folder's mtime is unchanged and a file
+    is only hashed again when its size or mtime changed
+    """
+    st = os.stat(path)
+    if cached and cached["mtime"] == st.st_mtime_ns:
+        names = list(cached["files"])
+    else:
+        cached = cached or {"files": {}}
+        names = [f.name for f in os.scandir(path) if f.is_file()]
+    files = {}
+    for name in names:
+        try:
+            fst = os.stat(join(path, name))
+        except FileNotFoundError:
+            continue
+        old = cached["files"].get(name)
+        if old and old[0] == fst.st_size and old[1] == fst.st_mtime_ns:
+            files[name] = old
+        else:
+            files[name] = [fst.st_size, fst.st_mtime_ns, file_digest(join(path, name))]
+    return {"mtime": st.st_mtime_ns, "files": files}
+
+
+def load_manifest(ctx):
+    try:
+        with open(manifest_path(ctx), "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+    return {kind: cached.get(kind, {}) for kind in ("scripts", "extension_attributes")}
+
+
+def save_manifest(ctx):
+    os.makedirs(dirname(manifest_path(ctx)), exist_ok=True)
+    with open(manifest_path(ctx) + ".tmp", "w") as f:
+        json.dump(ctx.manifest, f)
+    os.replace(manifest_path(ctx) + ".tmp", manifest_path(ctx))
+
+
+async def scan_folders(ctx, kind, changed):
+    """Scan stage of the upload pipeline: refreshes the manifest entries of
+    kind and yields each folder to upload as soon as it has been scanned.
+    Without --update_all only the changed folders are looked at
+    """
+    cached = ctx.manifest[kind]
+    if ctx.update_all:
+        folders = await run_blocking(ctx, list_folders, join(ctx.sync_path, kind))
+        folders = [folder for folder in folders if in_shard(ctx, kind, folder)]
+        # Entries of the other shards stay for their next run
+        ctx.manifest[kind] = {
+            folder: entry
+            for folder, entry in cached.items()
+            if not in_shard(ctx, kind, folder)
+        }
+    else:
+        folders = changed
+    for folder in folders:
+        try:
+            ctx.manifest[kind][folder] = await run_blocking(
+                ctx, scan_folder, join(ctx.sync_path, kind, folder), cached.get(folder)
+            )
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        yield folder
+
+
+def list_folders(path):
+    try:
+        return [f.name for f in os.scandir(path) if f.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+def manifest_file(ctx, kind, folder, extensions):
+    """First file of the folder with one of extensions, or None"""
+    for name in sorted(ctx.manifest[kind][folder]["files"]):
+        if name.split(".")[-1] in extensions:
+            return name
+    return None
+
+
+def load_ledger(target):
+    try:
+        with open(target.state_path("ledger", shard_suffix(target.ctx)), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_ledger(target):
+    path = target.state_path("ledger", shard_suffix(target.ctx))
+    os.makedirs(dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(target.ledger, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def journal_path(target):
+    return join(
+        target.ctx.args.state_dir,
+        "journal",
+        target.name + shard_suffix(target.ctx) + ".jsonl",
+    )
+
+
+def open_journal(target):
+    """Starts the journal of this run. With --resume the journal a killed
+    run left behind is replayed into the ledger first, so the objects it
+    confirmed are skipped like any other already pushed payload
+    """
+    args = target.ctx.args
+    path = journal_path(target)
+    os.makedirs(dirname(path), exist_ok=True)
+    if args.resume:
+        replayed = 0
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut short by the kill
+                        continue
+                    pushed = target.ledger.setdefault(entry["resource"], {})
+                    if entry["digest"] is None:
+                        pushed.pop(entry["name"], None)
+                    else:
+                        pushed[entry["name"]] = entry["digest"]
+                    replayed += 1
+            target.log("Resuming after %d confirmed objects" % replayed)
+        except FileNotFoundError:
+            pass
+    target.journal = open(path, "a" if args.resume else "w")
+
+
+def journal_object(target, resource, name, digest, status, obj_id):
+    """Records an object the JSS confirmed, digest None for a delete. Only
+    ever called on the event loop and each entry is one write of a whole
+    line, so concurrent upload tasks can't interleave their entries. The
+    line is flushed straight away to survive the process being killed
+    """
+    if target.journal is None:
+        return
+    entry = {
+        "resource": resource,
+        "name": name,
+        "digest": digest,
+        "status": status,
+        "id": obj_id,
+    }
+    target.journal.write(json.dumps(entry, sort_keys=True) + "\n")
+    target.journal.flush()
+
+
+def close_journal(target):
+    """Drops the journal once the ledger it fed is saved"""
+    if target.journal is None:
+        return
+    target.journal.close()
+    target.journal = None
+    os.remove(journal_path(target))
+
+
+def canonical_xml(template):
+    """Returns a copy of template normalised the way tools/download.py
+    writes it: CRs removed from the script body, surrounding whitespace
+    ignored everywhere else and server-only elements dropped
+    """
+    template = copy.deepcopy(template)
+    for tag in SERVER_ONLY_ELEMENTS:
+        for e in template.findall(tag):
+            template.remove(e)
+    scripts = [template.find(path) for path in SCRIPT_ELEMENTS]
+    for e in template.iter():
+        if e.text is not None:
+            e.text = e.text.replace("\r", "")
+            if not any(e is s for s in scripts):
+                e.text = e.text.strip()
+        e.text = e.text or None
+        e.tail = None
+    return template
+
+
+def canonical_digest(template):
+    return hashlib.sha256(
+        ET.tostring(canonical_xml(template), encoding="utf-8")
+    ).hexdigest()
+
+
+def canonical_text(template):
+    """The canonical form pretty printed like download.py, for diffs"""
+    return minidom.parseString(
+        ET.tostring(canonical_xml(template), encoding="unicode")
+    ).toprettyxml(indent="   ")
+
+
+async def fetch_snapshot(session, target):
+    """Downloads every remote object concurrently into the target's
+    remote templates
+    """
+    await asyncio.gather(
+        *[
+            get_remote_template(session, target, resource, obj_id)
+            for resource, index in target.indexes()
+            for obj_id in index.values()
+        ]
+    )
+
+
+def save_snapshot(target):
+    """Stores the indexes, categories and fetched objects so the sync run
+    after a --plan can use them with --use_snapshot instead of
+    downloading everything again
+    """
+    objects = {}
+    for (resource, obj_id), future in target.remote_templates.items():
+        if future.done() and not future.exception() and future.result():
+            objects.setdefault(resource, {})[obj_id] = future.result()
+    path = target.state_path("snapshot")
+    os.makedirs(dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(
+            {
+                "created": time.time(),
+                "categories": sorted(target.categories),
+                "indexes": dict(target.indexes()),
+                "objects": objects,
+            },
+            f,
+        )
+    os.replace(path + ".tmp", path)
+
+
+def load_snapshot(target):
+    """Returns the snapshot saved by --plan, or None if there is none or
+    it's older than --snapshot_max_age seconds
+    """
+    args = target.ctx.args
+    try:
+        with open(target.state_path("snapshot"), "r") as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - snapshot["created"] > args.snapshot_max_age:
+        print("Ignoring snapshot older than %ss" % args.snapshot_max_age)
+        return None
+    return snapshot
+
+
+def restore_snapshot(target, snapshot):
+    """Seeds the target's remote templates, categories and the script and
+    EA indexes from snapshot
+    """
+    for resource, objects in snapshot["objects"].items():
+        for obj_id, xml in objects.items():
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(xml)
+            target.remote_templates[(resource, obj_id)] = future
+    indexes = snapshot["indexes"]
+    target.categories = set(snapshot["categories"])
+    target.script_index = indexes["scripts"]
+    target.ea_index = indexes["computerextensionattributes"]
+
+
+async def plan_object(session, target, rtype, template):
+    """Send stage of --plan: records what the sync would do with template"""
+    name = template.find("name").text
+    index = target.index(rtype.resource)
+    if name not in index:
+        target.plan.append(("create", rtype.label, name, []))
+        return
+    remote = await get_remote_template(session, target, rtype.resource, index[name])
+    local_text = await run_blocking(target.ctx, canonical_text, template)
+    remote_text = (
+        "" if remote is None else await run_blocking(target.ctx, canonical_text, remote)
+    )
+    if local_text == remote_text:
+        target.plan.append(("unchanged", rtype.label, name, []))
+        return
+    diff = difflib.unified_diff(
+        remote_text.splitlines(),
+        local_text.splitlines(),
+        "remote",
+        "local",
+        lineterm="",
+    )
+    target.plan.append(("update", rtype.label, name, list(diff)))
+
+
+def plan_has_changes(ctx):
+    return any(
+        action != "unchanged"
+        for target in ctx.targets
+        for action, _, _, _ in target.plan
+    )
+
+
+def print_plan(target):
+    counts = collections.Counter(action for action, _, _, _ in target.plan)
+    if len(target.ctx.targets) > 1:
+        print("Plan for %s:" % target.name)
+    print(
+        "Plan: %d to create, %d to update, %d to rename, %d to delete, %d unchanged"
+        % (
+            counts["create"],
+            counts["update"],
+            counts["rename"],
+            counts["delete"],
+            counts["unchanged"],
+        )
+    )
+    marks = {"create": "+", "update": "~", "rename": ">", "delete": "-"}
+    for action, label, name, diff in sorted(target.plan):
+        if action == "unchanged":
+            continue
+        print("%s %s %s" % (marks[action], label, name))
+        for line in diff:
+            print("    " + line)
+
+
+async def get_remote_digest(session, target, resource, obj_id):
+    template = await get_remote_template(session, target, resource, obj_id)
+    if template is None:
+        return None
+    return await run_blocking(target.ctx, canonical_digest, template)
+
+
+async def rebuild_ledger(session, target):
+    """Rebuilds the ledger from what is actually on the JSS so drift made
+    outside of git gets uploaded again. The fetched objects stay memoized
+    for the templates of the sync that follows
+    """
+    ledger = {}
+    for resource, index in target.indexes():
+        names = list(index)
+        digests = await asyncio.gather(
+            *[get_remote_digest(session, target, resource, index[n]) for n in names]
+        )
+        ledger[resource] = {n: d for n, d in zip(names, digests) if d is not None}
+    return ledger
+
+
+async def drift_target(session, target, scan):
+    """--drift: builds the payload of every folder as a sync would and
+    compares its canonical digest with the object of the same name on the
+    JSS. The remote objects are fetched concurrently with the build, from
+    the drift cache where it has them, see load_remote_digests()
+    """
+    ctx = target.ctx
+    local = {}
+
+    async def read(rtype, folder, _):
+        return await read_once(ctx, rtype, folder)
+
+    async def build(rtype, folder, read):
+        return await rtype.build(session, target, folder, *read)
+
+    async def digest(rtype, folder, template):
+        name = template.find("name").text
+        local[rtype.resource, name] = await run_blocking(
+            ctx, canonical_digest, template
+        )
+
+    target.log("Comparing the repo with the JSS...")
+    cache = await run_blocking(ctx, load_remote_digests, target)
+    remote = asyncio.ensure_future(fetch_remote_digests(session, target, cache))
+    try:
+        await run_pipeline(scan.subscribe(), read, build, digest, target)
+    finally:
+        remote = await remote
+    # Folders without an XML of their own were built from the remote
+    # object, which makes what the build fetched fresher than the cache
+    for (resource, obj_id), future in target.remote_templates.items():
+        key = (resource, str(obj_id))
+        if key in cache and future.done() and not future.exception():
+            fresh = await get_remote_digest(session, target, resource, obj_id)
+            remote[key] = None if fresh is None else [fresh, time.time()]
+    for rtype in RESOURCE_TYPES:
+        index = target.index(rtype.resource)
+        for name, obj_id in index.items():
+            entry = remote.get((rtype.resource, str(obj_id)))
+            if (rtype.resource, name) not in local:
+                target.drift.append(("remote only", rtype.label, name))
+            elif entry is None:
+                target.failed.append((rtype.label, name, "Unable to fetch"))
+            elif entry[0] != local[rtype.resource, name]:
+                target.drift.append(("modified", rtype.label, name))
+            else:
+                target.drift.append(("in sync", rtype.label, name))
+        for resource, name in local:
+            if resource == rtype.resource and name not in index:
+                target.drift.append(("repo only", rtype.label, name))
+    await run_blocking(ctx, save_remote_digests, target, remote)
+
+
+async def fetch_remote_digests(session, target, cache):
+    """(resource, id) -> [digest, time fetched] of every remote object,
+    fetching all that aren't in cache at once through the limiter
+    """
+
+    async def fetch(resource, obj_id):
+        digest = await get_remote_digest(session, target, resource, obj_id)
+        return None if digest is None else [digest, time.time()]
+
+    keys = [
+        (resource, str(obj_id))
+        for resource, index in target.indexes()
+        for obj_id in index.values()
+    ]
+    missing = [key for key in keys if key not in cache]
+    entries = await asyncio.gather(*[fetch(*key) for key in missing])
+    digests = {key: cache[key] for key in keys if key in cache}
+    digests.update(zip(missing, entries))
+    return digests
+
+
+def load_remote_digests(target):
+    """The drift cache: (resource, id) -> [digest, time fetched] of the
+    remote objects an earlier --drift fetched less than --drift_max_age
+    seconds ago. A sync that changes the JSS drops it, see
+    forget_remote_digests()
+    """
+    try:
+        with open(target.state_path("drift"), "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    oldest = time.time() - target.ctx.args.drift_max_age
+    return {
+        (resource, obj_id): entry
+        for resource, entries in cache.items()
+        for obj_id, entry in entries.items()
+        if entry[1] >= oldest
+    }
+
+
+def save_remote_digests(target, digests):
+    cache = {}
+    for (resource, obj_id), entry in digests.items():
+        if entry is not None:
+            cache.setdefault(resource, {})[obj_id] = entry
+    path = target.state_path("drift")
+    os.makedirs(dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def forget_remote_digests(target):
+    try:
+        os.remove(target.state_path("drift"))
+    except FileNotFoundError:
+        pass
+
+
+def drift_found(ctx):
+    return any(
+        state != "in sync" for target in ctx.targets for state, _, _ in target.drift
+    )
+
+
+def print_drift(target):
+    counts = collections.Counter(state for state, _, _ in target.drift)
+    if len(target.ctx.targets) > 1:
+        print("Drift of %s:" % target.name)
+    print(
+        "Drift: %d modified, %d only on the JSS, %d only in the repo, %d in sync"
+        % (
+            counts["modified"],
+            counts["remote only"],
+            counts["repo only"],
+            counts["in sync"],
+        )
+    )
+    marks = {"modified": "~", "remote only": "-", "repo only": "+"}
+    for state, label, name in sorted(target.drift):
+        if state == "in sync":
+            continue
+        print("%s %s %s" % (marks[state], label, name))
+
+
+async def read_extension_attribute(ctx, ext_attr):
+    # Get the script file within the folder, we'll only use
+    # the first one in case there are multiple files
+    script_file = manifest_file(
+        ctx, "extension_attributes", ext_attr, SUPPORTED_EA_EXTENSIONS
+    )
+    if script_file is None:
+        print("Warning: No script file found in extension_attributes/%s" % ext_attr)
+        return ""  # EAs are uploaded without a script
+    return await run_blocking(
+        ctx,
+        read_file,
+        join(ctx.sync_path, "extension_attributes", ext_attr, script_file),
+    )
+
+
+async def build_extension_attribute(session, target, ext_attr, data, local):
+    template = await get_ea_template(session, target, ext_attr, local)
+    if data:
+        template.find("input_type/script").text = data
+    if target.ctx.args.verbose:
+        await run_blocking(target.ctx, print_template, template)
+    return template
+
+
+async def send_extension_attribute(session, target, ext_attr, template):
+    status = await upsert_object(
+        session, target, "computerextensionattributes", target.ea_index, template
+    )
+    if target.ctx.args.verbose:
+        print("response status: ", status)
+        print("EA: ", ext_attr)
+        print("EA Name: ", template.find("name").text)
+    if status is None:
+        target.log("Unchanged Extension Attribute: %s" % template.find("name").text)
+    elif status in (201, 200):
+        target.log("Uploaded Extension Attribute: %s" % template.find("name").text)
+    else:
+        target.log("Error uploading script: %s" % template.find("name").text)
+        print("Error: %s" % status)
+        target.failed.append(("extension attribute", ext_attr, "HTTP %s" % status))
+    return status
+
+
+async def get_ea_template(session, target, ext_attr, local):
+    # The XML of the folder is parsed once and copied for every target
+    args = target.ctx.args
+    if local is not None:
+        template = copy.deepcopy(local)
+    else:
+        template = None
+        if ext_attr in target.ea_index:
+            template = await get_remote_template(
+                session,
+                target,
+                "computerextensionattributes",
+                target.ea_index[ext_attr],
+            )
+        if template is None:
+            template = await run_blocking(
+                target.ctx,
+                parse_xml_file,
+                join(target.ctx.sync_path, "templates/ea.xml"),
+            )
+    # name is mandatory, so we use the foldername if nothing is set in
+    # a template
+    if args.verbose:
+        await run_blocking(target.ctx, print_template, template)
+    category = template.find("category")
+    if category is not None and not await ensure_category(
+        session, target, category.text
+    ):
+        c = category.text
+        category.text = "None"
+        if args.verbose:
+            print(
+                f"""WARNING: Unable to create category {c} in the JSS,
+                  setting to None"""
+            )
+    if template.find("name") is None:
+        ET.SubElement(template, "name").text = ext_attr
+    elif not template.find("name").text or template.find("name").text is None:
+        template.find("name").text = ext_attr
+    return template
+
+
+async def read_script(ctx, script):
+    script_file = manifest_file(ctx, "scripts", script, SUPPORTED_SCRIPT_EXTENSIONS)
+    if script_file is None:
+        print("Warning: No script file found in scripts/%s" % script)
+        return None  # Need to skip if no script.
+    return await run_blocking(
+        ctx, read_file, join(ctx.sync_path, "scripts", script, script_file)
+    )
+
+
+async def build_script(session, target, script, data, local):
+    template = await get_script_template(session, target, script, local)
+    template.find("script_contents").text = data
+    return template
+
+
+async def send_script(session, target, script, template):
+    status = await upsert_object(
+        session, target, "scripts", target.script_index, template
+    )
+    if status is None:
+        target.log("Unchanged script: %s" % template.find("name").text)
+    elif status in (201, 200):
+        target.log("Uploaded script: %s" % template.find("name").text)
+    else:
+        target.log("Error uploading script: %s" % template.find("name").text)
+        print("Error: %s" % status)
+        target.failed.append(("script", script, "HTTP %s" % status))
+    return status
+
+
+async def get_script_template(session, target, script, local):
+    # The XML of the folder is parsed once and copied for every target
+    args = target.ctx.args
+    if local is not None:
+        template = copy.deepcopy(local)
+    else:
+        template = None
+        if script in target.script_index:
+            template = await get_remote_template(
+                session, target, "scripts", target.script_index[script]
+            )
+        if template is None:
+            template = await run_blocking(
+                target.ctx,
+                parse_xml_file,
+                join(target.ctx.sync_path, "templates/script.xml"),
+            )
+    # name is mandatory, so we use the filename if nothing is set in a template
+    if args.verbose:
+        await run_blocking(target.ctx, print_template, template)
+    category = template.find("category")
+    if category is not None and not await ensure_category(
+        session, target, category.text
+    ):
+        template.remove(category)
+        if args.verbose:
+            print(
+                f"""WARNING: Unable to create category "{category.text}" in the JSS,
+                    setting to None"""
+            )
+    if template.find("name") is None:
+        ET.SubElement(template, "name").text = script
+    elif not template.find("name").text or template.find("name").text is None:
+        template.find("name").text = script
+    return template
+
+
+async def get_remote_template(session, target, resource, obj_id):
+    """Returns a fresh copy of the remote XML for resource/id, or None if it
+    can't be fetched. The download is memoized for the whole run and
+    concurrent callers share a single request
+    """
+    key = (resource, obj_id)
+    if key not in target.remote_templates:
+        target.remote_templates[key] = asyncio.ensure_future(
+            fetch_remote_template(session, target, resource, obj_id)
+        )
+    xml = await asyncio.shield(target.remote_templates[key])
+    if xml is None:
+        return None
+    return ET.fromstring(xml)
+
+
+async def fetch_remote_template(session, target, resource, obj_id):
+    status, body = await jss_request(
+        session, target, "GET", "/JSSResource/%s/id/%s" % (resource, obj_id)
+    )
+    if status == 200:
+        return body
+    return None
+
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(levelname)7s: %(message)s",
-    stream=sys.stderr,
-)
-LOG = logging.getLogger("")
+async def upsert_object(session, target, resource, index, template):
+    """Uploads template with a single request: a PUT by id when the name is
+    in the prefetched index, a POST otherwise. Returns the response status,
+    or None when the ledger shows this exact payload is already on the JSS
+    """
+    name = template.find("name").text
+    digest = await run_blocking(target.ctx, canonical_digest, template)
+    pushed = target.ledger.setdefault(resource, {})
+    if name in index and pushed.get(name) == digest:
+        return None
+    if name not in index:
+        status, body = await post_object(session, target, resource, template)
+        if status in (201, 200):
+            # Keep the index current so a later upsert of the same name
+            # in this run doesn't create a duplicate
+            created = ET.fromstring(body).find("id")
+            if created is not None:
+                index[name] = created.text
+            pushed[name] = digest
+            journal_object(target, resource, name, digest, status, index.get(name))
+            return status
+        if status is not None:
+            return status
+        # The JSS created the object before the POST failed on our end,
+        # PUT over it by id so the content is certain
+        index[name] = body
+    status, _ = await jss_request(
+        session,
+        target,
+        "PUT",
+        "/JSSResource/%s/id/%s" % (resource, index[name]),
+        data=ET.tostring(template),
+    )
+    if status in (201, 200):
+        pushed[name] = digest
+        journal_object(target, resource, name, digest, status, index[name])
+    return status
 
-# The Jenkins file will contain a list of changes scripts and eas
-# in $scripts and $eas.
-# Use this variable to add a Slack emoji in front of each item if
-# you use a post-build action for a Slack custom message
-SLACK_EMOJI = ":white_check_mark: "
-SUPPORTED_SCRIPT_EXTENSIONS = ("sh", "py", "pl", "swift", "rb")
-SUPPORTED_EA_EXTENSIONS = ("sh", "py", "pl", "swift", "rb")
-CATEGORIES = []
+
+async def post_object(session, target, resource, template):
+    """POSTs template with its own retry budget. POSTs aren't idempotent,
+    so before each retry the JSS is checked for an object that the failed
+    attempt may have created anyway. Returns (None, id) in that case
+    """
+    args = target.ctx.args
+    name = template.find("name").text
+    attempt = 0
+    while True:
+        try:
+            status, body = await jss_request(
+                session,
+                target,
+                "POST",
+                "/JSSResource/%s/id/0" % resource,
+                retries=0,
+                data=ET.tostring(template),
+            )
+            if status not in RETRY_STATUSES or attempt >= args.post_retries:
+                return status, body
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt >= args.post_retries:
+                raise
+        attempt += 1
+        LOG.debug("Retrying POST of %s %s", resource, name)
+        await asyncio.sleep(backoff_delay(target.ctx, attempt))
+        obj_id = await find_object_id(session, target, resource, name)
+        if obj_id is not None:
+            return None, obj_id
 
 
-# https://github.com/lazymutt/Jamf-Pro-API-Sampler/blob/5f8efa92911271248f527e70bd682db79bc600f2/jamf_duplicate_detection.py#L99
-def get_uapi_token():
+async def find_object_id(session, target, resource, name):
+    status, body = await jss_request(
+        session,
+        target,
+        "GET",
+        "/JSSResource/%s/name/%s" % (resource, quote(name, safe="")),
+    )
+    if status == 200:
+        return ET.fromstring(body).find("id").text
+    return None
+
+
+async def get_resource_index(session, target, resource):
+    """Fetches the list endpoint for resource once and returns a
+    name -> id dict of every object on the JSS
     """
-    fetches api token
+    status, body = await jss_request(session, target, "GET", "/JSSResource/" + resource)
+    if status in (201, 200):
+        return {
+            e.find("name").text: e.find("id").text
+            for e in ET.fromstring(body)
+            if e.find("id") is not None
+        }
+    return {}
+
+
+async def get_existing_categories(session, target):
+    cached = await run_blocking(target.ctx, load_categories, target)
+    if cached is not None:
+        return cached
+    status, body = await jss_request(session, target, "GET", "/JSSResource/categories")
+    if status in (201, 200):
+        categories = {
+            c.find("name").text for c in ET.fromstring(body).findall("category")
+        }
+        await run_blocking(target.ctx, save_categories, target, categories, time.time())
+        return categories
+    return set()
+
+
+def load_categories(target):
+    """Category names cached by an earlier run, or None once the cache is
+    older than --category_ttl
     """
-    jamf_test_url = url + "/api/v1/auth/token"
-    response = requests.post(url=jamf_test_url, auth=(username, password))
-    response_json = response.json()
-    return response_json["token"]
+    try:
+        with open(target.state_path("categories"), "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cache.get("fetched", 0) > target.ctx.args.category_ttl:
+        return None
+    return set(cache["categories"])
+
 
+def save_categories(target, categories, fetched):
+    path = target.state_path("categories")
+    os.makedirs(dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"fetched": fetched, "categories": sorted(categories)}, f, indent=1)
+    os.replace(path + ".tmp", path)
 
-def invalidate_uapi_token(uapi_token):
+
+def add_cached_categories(target, names):
+    """Adds categories this run created to the cache without extending its
+    lifetime, so everything else is still refetched on schedule
     """
-    invalidates api token
+    try:
+        with open(target.state_path("categories"), "r") as f:
+            fetched = json.load(f).get("fetched", 0)
+    except (OSError, ValueError):
+        return
+    save_categories(target, target.categories | set(names), fetched)
+
+
+async def ensure_category(session, target, name):
+    """Returns whether category name exists on the JSS, creating it the
+    first time a template of the run needs it. Concurrent callers share a
+    single request, so every missing category is created once while the
+    templates are being built. With --plan creations are only recorded
     """
-    jamf_test_url = url + "/api/v1/auth/invalidate-token"
-    headers = {"Accept": "*/*", "Authorization": "Bearer " + uapi_token}
-    _ = requests.post(url=jamf_test_url, headers=headers)
+    if not name or name in target.categories or name in NO_CATEGORY:
+        return True
+    if name not in target.category_creates:
+        target.category_creates[name] = asyncio.ensure_future(
+            create_category(session, target, name)
+        )
+    return await asyncio.shield(target.category_creates[name])
 
 
-# https://github.com/lazymutt/Jamf-Pro-API-Sampler/blob/5f8efa92911271248f527e70bd682db79bc600f2/jamf_duplicate_detection.py#L99
-def get_uapi_token():
+async def create_category(session, target, name):
+    if target.ctx.args.plan:
+        target.plan.append(("create", "category", name, []))
+        return True
+    if target.ctx.args.drift:
+        # Only compared, the payload keeps the category it would be created for
+        return True
+    template = ET.Element("category")
+    ET.SubElement(template, "name").text = name
+    status, _ = await jss_request(
+        session,
+        target,
+        "POST",
+        "/JSSResource/categories/id/0",
+        data=ET.tostring(template),
+    )
+    # 409 is a category someone else created since the list was fetched
+    if status not in (201, 200, 409):
+        target.log("Error creating category: %s" % name)
+        return False
+    target.log("Created category: %s" % name)
+    target.categories.add(name)
+    await run_blocking(target.ctx, add_cached_categories, target, [name])
+    return True
+
+
+# Everything sync.py uploads. folder is the directory in the repo,
+# resource the JSSResource endpoint and label names one object in messages
+ResourceType = collections.namedtuple(
+    "ResourceType", "folder resource label title read build send"
+)
+RESOURCE_TYPES = (
+    ResourceType(
+        "scripts",
+        "scripts",
+        "script",
+        "Scripts",
+        read_script,
+        build_script,
+        send_script,
+    ),
+    ResourceType(
+        "extension_attributes",
+        "computerextensionattributes",
+        "extension attribute",
+        "Extension Attributes",
+        read_extension_attribute,
+        build_extension_attribute,
+        send_extension_attribute,
+    ),
+)
+
+
+def changed_folders(ctx, kind):
+    """The folders of kind to upload, a list shared with the jenkins file"""
+    return {
+        "scripts": ctx.changed_scripts,
+        "extension_attributes": ctx.changed_ext_attrs,
+    }[kind]
+
+
+async def scan_resource_types(ctx):
+    """Scan stage for all of RESOURCE_TYPES, one after the other. The
+    folders changed for any of the targets are scanned
     """
-    fetches api token
+    for rtype in RESOURCE_TYPES:
+        changed = changed_folders(ctx, rtype.folder)
+        if not changed and not ctx.update_all:
+            print("No Changes in %s" % rtype.title)
+            continue
+        if ctx.update_all:
+            print("Copying all %s..." % rtype.title.lower())
+        async for folder in scan_folders(ctx, rtype.folder, changed):
+            yield rtype, folder
+
+
+class Fanout(object):
+    """Replays one async iterator to several consumers, each at its own
+    pace. Whichever consumer is ahead pulls the next item from source and
+    the others catch up from the items seen so far
     """
-    jamf_test_url = url + "/api/v1/auth/token"
-    response = requests.post(url=jamf_test_url, auth=(username, password))
-    response_json = response.json()
-    return response_json["token"]
 
+    def __init__(self, source):
+        self.source = source
+        self.items = []
+        self.done = False
+        self.lock = asyncio.Lock()
+
+    async def subscribe(self):
+        i = 0
+        while True:
+            if i == len(self.items) and not self.done:
+                async with self.lock:
+                    if i == len(self.items) and not self.done:
+                        try:
+                            self.items.append(await self.source.__anext__())
+                        except StopAsyncIteration:
+                            self.done = True
+            if i < len(self.items):
+                yield self.items[i]
+                i += 1
+            elif self.done:
+                return
 
-def invalidate_uapi_token(uapi_token):
+
+async def read_object(ctx, rtype, folder):
+    """Reads what the payloads of one folder are built from: the script
+    and the parsed XML template, if the folder has one
     """
-    invalidates api token
+    data = await rtype.read(ctx, folder)
+    if data is None:
+        return None
+    xml_file = manifest_file(ctx, rtype.folder, folder, ("xml",))
+    local = None
+    if xml_file is not None:
+        local = await run_blocking(
+            ctx, parse_xml_file, join(ctx.sync_path, rtype.folder, folder, xml_file)
+        )
+    return data, local
+
+
+async def read_once(ctx, rtype, folder):
+    """Read stage shared by the targets: the first target to reach a
+    folder reads it, the others wait for the same result, which is dropped
+    once the last target that syncs the folder has it
     """
-    jamf_test_url = url + "/api/v1/auth/invalidate-token"
-    headers = {"Accept": "*/*", "Authorization": "Bearer " + uapi_token}
-    _ = requests.post(url=jamf_test_url, headers=headers)
+    key = (rtype.folder, folder)
+    if key not in ctx.reads:
+        ctx.reads[key] = [
+            asyncio.ensure_future(read_object(ctx, rtype, folder)),
+            sum(1 for target in ctx.targets if target.wants(rtype.folder, folder)),
+        ]
+    entry = ctx.reads[key]
+    entry[1] -= 1
+    if entry[1] <= 0:
+        del ctx.reads[key]
+    return await asyncio.shield(entry[0])
 
 
-def check_for_changes():
-    """Looks for files that were changed between the current commit and
-    the last commit so we don't upload everything on every run
-      --jenkins will utilize $GIT_PREVIOUS_COMMIT and $GIT_COMMIT
-        environmental variables
-      --update_all can be invoked to upload all scripts and
-        extension attributes
+def local_object_name(sync_path, kind, folder):
+    """Name the object in kind/folder is uploaded under: the name in its
+    XML, else the folder name like get_script_template does
     """
-    # This line will work with the environmental variables in Jenkins
-    if args.jenkins:
-        git_changes = (
-            os.popen("git diff --name-only $GIT_PREVIOUS_COMMIT $GIT_COMMIT")
-            .read()
-            .split("\n")
+    for entry in sorted(os.scandir(join(sync_path, kind, folder)), key=str):
+        if entry.name.endswith(".xml"):
+            name = parse_xml_file(entry.path).find("name")
+            if name is not None and name.text:
+                return name.text
+            break
+    return folder
+
+
+async def object_name_at(ctx, commit, kind, folder):
+    """Name the object in kind/folder had at commit, for folders that are
+    no longer in the checkout
+    """
+    try:
+        out = await git(
+            ctx, "ls-tree", "-z", "--name-only", commit, "--", "%s/%s/" % (kind, folder)
         )
+        for path in sorted(out.decode("utf-8", "surrogateescape").split("\0")):
+            if path.endswith(".xml"):
+                xml = await git(ctx, "show", "%s:./%s" % (commit, path))
+                name = ET.fromstring(xml).find("name")
+                if name is not None and name.text:
+                    return name.text
+                break
+    except (subprocess.CalledProcessError, ET.ParseError):
+        pass
+    return folder
 
-    # Compare the last two commits to determine the list of files that
-    # were changed
-    else:
-        git_commits = (
-            os.popen('git log -2 --pretty=oneline --pretty=format:"%h"')
-            .read()
-            .split("\n")
+
+async def resolve_removals(target, plan=False):
+    """Turns the deletions and renames of target.changes into remote names. A
+    renamed object takes over the id of its old name in the index, so the
+    upload that follows renames it in place with a PUT. Returns the
+    (rtype, name) of the objects left to delete, which never includes a
+    name that is still uploaded from some folder
+    """
+    rtypes = {rtype.folder: rtype for rtype in RESOURCE_TYPES}
+    indexes = dict(target.indexes())
+    kept = set()
+    renames = []
+    removed = []
+    for change in target.changes.values():
+        rtype = rtypes[change.kind]
+        if change.status == "D":
+            name = await object_name_at(
+                target.ctx, target.diff_base, change.kind, change.folder
+            )
+            removed.append((rtype, name))
+            continue
+        name = await run_blocking(
+            target.ctx,
+            local_object_name,
+            target.ctx.sync_path,
+            change.kind,
+            change.folder,
+        )
+        kept.add((rtype.resource, name))
+        if change.status == "R":
+            old = await object_name_at(
+                target.ctx, target.diff_base, change.kind, change.old_folder
+            )
+            if old != name:
+                renames.append((rtype, old, name))
+    deletes = []
+    for rtype, old, name in renames:
+        index = indexes[rtype.resource]
+        if old not in index or (rtype.resource, old) in kept:
+            continue
+        if name in index:
+            # Both names are on the JSS already, the old one is a leftover
+            removed.append((rtype, old))
+            continue
+        index[name] = index.pop(old)
+        target.ledger.get(rtype.resource, {}).pop(old, None)
+        if plan:
+            target.plan.append(("rename", rtype.label, "%s -> %s" % (old, name), []))
+        else:
+            target.log("Renaming %s: %s -> %s" % (rtype.label, old, name))
+            target.stats["renamed"] += 1
+    for rtype, name in removed:
+        if name in indexes[rtype.resource] and (rtype.resource, name) not in kept:
+            deletes.append((rtype, name))
+    return deletes
+
+
+async def delete_objects(session, target, deletes, plan=False):
+    """DELETEs the objects removed from the repo by id, all at once through
+    the limiter. More than --max_deletes of them fails the run instead
+    """
+    args = target.ctx.args
+    if plan:
+        for rtype, name in deletes:
+            target.plan.append(("delete", rtype.label, name, []))
+        return
+    if len(deletes) > args.max_deletes:
+        target.log(
+            "Refusing to delete %d objects, more than --max_deletes %d"
+            % (len(deletes), args.max_deletes)
         )
-        command = "git diff --name-only" + " " + git_commits[1] + " " + git_commits[0]
-        git_changes = os.popen(command).read().split("\n")
+        for rtype, name in deletes:
+            target.failed.append((rtype.label, name, "delete over --max_deletes"))
+        return
 
-    for i in git_changes:
-        if "extension_attributes/" in i and i.split("/")[1] not in changed_ext_attrs:
-            changed_ext_attrs.append(i.split("/")[1])
+    async def delete(rtype, name):
+        index = target.index(rtype.resource)
+        status, _ = await jss_request(
+            session,
+            target,
+            "DELETE",
+            "/JSSResource/%s/id/%s" % (rtype.resource, index[name]),
+        )
+        # Gone already is as good as deleted
+        if status in (200, 404):
+            target.log("Deleted %s: %s" % (rtype.label, name))
+            journal_object(target, rtype.resource, name, None, status, index.pop(name))
+            target.ledger.get(rtype.resource, {}).pop(name, None)
+            target.stats["deleted"] += 1
+        else:
+            target.log("Error deleting %s: %s" % (rtype.label, name))
+            target.failed.append((rtype.label, name, "HTTP %s" % status))
 
-    for i in git_changes:
-        if "scripts/" in i and i.split("/")[1] not in changed_scripts:
-            changed_scripts.append(i.split("/")[1])
+    await asyncio.gather(*[delete(rtype, name) for rtype, name in deletes])
 
 
-def write_jenkins_file():
-    """Write changed_ext_attrs and changed_scripts to jenkins file.
-    $eas will contains the changed extension attributes,
-    $scripts will contains the changed scripts
-    If there are no changes, the variable will be set to 'None'
+async def upload_all(session, target, scan, plan=False):
+    """Uploads every resource type to target through a single pipeline, so
+    they all share the session, the send workers and the adaptive limiter
+    and one type's tail overlaps with the next type's uploads. The folders
+    come from scan, which every target replays at its own pace. With plan
+    the templates are only compared with the JSS and recorded in the plan
     """
 
-    if not changed_ext_attrs:
-        contents = "eas=" + "None"
-    else:
-        contents = "eas=" + SLACK_EMOJI + changed_ext_attrs[0] + "\\n" + "\\"
-        for changed_ext_attr in changed_ext_attrs[1:]:
-            contents = contents + "\n" + SLACK_EMOJI + changed_ext_attr + "\\n" + "\\"
+    started = {}
 
-    if not changed_scripts:
-        contents = contents.rstrip("\\") + "\n" + "scripts=" + "None"
+    async def folders():
+        async for rtype, folder in scan.subscribe():
+            if target.wants(rtype.folder, folder):
+                yield rtype, folder
 
-    else:
-        contents = (
-            contents.rstrip("\\")
-            + "\n"
-            + "scripts="
-            + SLACK_EMOJI
-            + changed_scripts[0]
-            + "\\n"
-            + "\\"
-        )
-        for changed_script in changed_scripts[1:]:
-            contents = contents + "\n" + SLACK_EMOJI + changed_script + "\\n" + "\\"
+    async def read(rtype, folder, _):
+        started[(rtype.label, folder)] = time.monotonic()
+        return await read_once(target.ctx, rtype, folder)
 
-    with open("jenkins.properties", "w") as f:
-        f.write(contents)
+    async def build(rtype, folder, read):
+        return await rtype.build(session, target, folder, *read)
 
+    async def send(rtype, folder, template):
+        if plan:
+            return await plan_object(session, target, rtype, template)
+        status = await rtype.send(session, target, folder, template)
+        target.latencies.append(time.monotonic() - started.pop((rtype.label, folder)))
+        if status is None:
+            target.stats["unchanged"] += 1
+        elif status in (201, 200):
+            target.stats["uploaded"] += 1
+        return status
 
-async def upload_extension_attributes(session, url, user, passwd, semaphore):
-    # sync_path = dirname(realpath(__file__))
-    if not changed_ext_attrs and not args.update_all:
-        print("No Changes in Extension Attributes")
-        return
-    ext_attrs = [
-        f.name
-        for f in os.scandir(join(sync_path, "extension_attributes"))
-        if f.is_dir() and f.name in changed_ext_attrs
-    ]
-    if args.update_all:
-        print("Copying all extension attributes...")
-        ext_attrs = [
-            f.name
-            for f in os.scandir(join(sync_path, "extension_attributes"))
-            if f.is_dir()
-        ]
-    tasks = []
-    for ea in ext_attrs:
-        task = asyncio.ensure_future(
-            upload_extension_attribute(session, url, user, passwd, ea, semaphore)
+    deletes = await resolve_removals(target, plan)
+    await run_pipeline(folders(), read, build, send, target)
+    # Deletes go last, after anything that reuses their names was uploaded
+    await delete_objects(session, target, deletes, plan)
+
+
+class Syncer(object):
+    """Syncs the repo at sync_path to the targets added with add_target().
+    The options are the command line flags as keyword arguments, e.g.
+    Syncer(path, update_all=True). The session, API tokens, limits and
+    caches live as long as the Syncer, so run() can be called again and
+    again without starting cold. Runs of one Syncer never overlap, and
+    any number of Syncers can run on one event loop:
+
+        async with Syncer(path) as syncer:
+            syncer.add_target(url, username, password)
+            results = await syncer.run()
+    """
+
+    def __init__(self, sync_path, args=None, **options):
+        self.ctx = SyncContext(sync_path, args, **options)
+        self.session = None
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def add_target(
+        self,
+        url,
+        username,
+        password,
+        limit=None,
+        min_limit=None,
+        max_limit=None,
+        nodes=(),
+    ):
+        """Adds a JSS to sync to, limits default to the options"""
+        args = self.ctx.args
+        target = Target(
+            self.ctx,
+            url,
+            username,
+            password,
+            args.limit if limit is None else limit,
+            args.min_limit if min_limit is None else min_limit,
+            args.max_limit if max_limit is None else max_limit,
+            nodes,
         )
-        tasks.append(task)
-    await asyncio.gather(*tasks)
+        self.ctx.targets.append(target)
+        return target
 
+    async def run(self, folders=None):
+        """Syncs once and returns what was synced and what failed, see
+        SyncContext.results(). With folders, an iterable of (kind, folder)
+        such as ("scripts", "Foo"), just those are synced as they are in
+        the working tree, committed or not
+        """
+        async with self.lock:
+            ctx = self.ctx
+            ctx.reset()
+            if folders is not None:
+                ctx.folders = sorted(set(folders))
+            if ctx.executor is None:
+                ctx.executor = concurrent.futures.ThreadPoolExecutor(
+                    ctx.args.executor_workers
+                )
+            if self.session is None:
+                self.session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(ssl=ctx.args.do_not_verify_ssl)
+                )
+            await sync(ctx, self.session)
+            return ctx.results()
 
-async def upload_extension_attribute(session, url, user, passwd, ext_attr, semaphore):
-    has_script = True
+    async def close(self):
+        """Invalidates the API tokens and closes the session"""
+        if self.session is not None:
+            # A server that went away mustn't keep the others from
+            # finishing
+            await asyncio.gather(
+                *[
+                    target.tokens.invalidate(self.session)
+                    for target in self.ctx.targets
+                ],
+                return_exceptions=True,
+            )
+            await self.session.close()
+            self.session = None
+        if self.ctx.executor is not None:
+            self.ctx.executor.shutdown(wait=False)
+            self.ctx.executor = None
 
-    # sync_path = dirname(realpath(__file__))
-    # auth = aiohttp.BasicAuth(user, passwd)
-    headers = {
-        "Accept": "application/xml",
-        "Content-Type": "application/xml",
-        "Authorization": "Bearer " + token,
-    }
-    # Get the script files within the folder, we'll only use
-    # script_file[0] in case there are multiple files
-    script_file = [
-        f.name
-        for f in os.scandir(join(sync_path, "extension_attributes", ext_attr))
-        if f.is_file() and f.name.split(".")[-1] in SUPPORTED_EA_EXTENSIONS
-    ]
-    if script_file == []:
-        print("Warning: No script file found in extension_attributes/%s" % ext_attr)
-        has_script = False
-        # return  # Need to skip if no script.
-    if has_script:
-        with open(
-            join(sync_path, "extension_attributes", ext_attr, script_file[0]), "r"
-        ) as f:
-            data = f.read()
-    async with semaphore:
-        with async_timeout.timeout(args.timeout):
-            template = await get_ea_template(session, url, user, passwd, ext_attr)
-            async with session.get(
-                url
-                + "/JSSResource/computerextensionattributes/name/"
-                + template.find("name").text,
-                headers=headers,
-            ) as resp:
-                if has_script and data:
-                    template.find("input_type/script").text = data
-                if args.verbose:
-                    print(ET.tostring(template))
-                    print("response status initial get: ", resp.status)
-                if resp.status == 200:
-                    put_url = (
-                        url
-                        + "/JSSResource/computerextensionattributes/name/"
-                        + template.find("name").text
-                    )
-                    resp = await session.put(
-                        put_url, data=ET.tostring(template), headers=headers
-                    )
-                else:
-                    post_url = url + "/JSSResource/computerextensionattributes/id/0"
-                    resp = await session.post(
-                        post_url, data=ET.tostring(template), headers=headers
-                    )
-    if args.verbose:
-        print("response status: ", resp.status)
-        print("EA: ", ext_attr)
-        print("EA Name: ", template.find("name").text)
-    if resp.status in (201, 200):
-        print("Uploaded Extension Attribute: %s" % template.find("name").text)
-    else:
-        print("Error uploading script: %s" % template.find("name").text)
-        print("Error: %s" % resp.status)
-    return resp.status
-
-
-async def get_ea_template(session, url, user, passwd, ext_attr):
-    # auth = aiohttp.BasicAuth(user, passwd)
-    # sync_path = dirname(realpath(__file__))
-    xml_file = [
-        f.name
-        for f in os.scandir(join(sync_path, "extension_attributes", ext_attr))
-        if f.is_file() and f.name.split(".")[-1] in "xml"
-    ]
+
+class InotifyWatcher(object):
+    """Calls changed(kind, folder) for every object folder that is edited,
+    created, moved or deleted, as it happens, through inotify. Linux only:
+    creating one anywhere else raises AttributeError, see folder_watcher()
+    """
+
+    # From <sys/inotify.h>
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = (
+        IN_MODIFY
+        | IN_ATTRIB
+        | IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+    )
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, ctx, changed):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.sync_path = ctx.sync_path
+        self.changed = changed
+        # watch descriptor -> (kind, folder), folder None for kind itself
+        self.watches = {}
+
+    def start(self):
+        for rtype in RESOURCE_TYPES:
+            self.watch(rtype.folder, None)
+            for folder in list_folders(join(self.sync_path, rtype.folder)):
+                self.watch(rtype.folder, folder)
+        asyncio.get_event_loop().add_reader(self.fd, self.read)
+
+    def watch(self, kind, folder):
+        path = join(self.sync_path, kind, folder or "")
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd >= 0:
+            self.watches[wd] = (kind, folder)
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            kind, folder = self.watches[wd]
+            if folder is None:
+                # Only the folders of kind are objects, not its other files
+                if not name or not mask & self.IN_ISDIR:
+                    continue
+                folder = name
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.watch(kind, folder)
+            self.changed(kind, folder)
+
+    def stop(self):
+        asyncio.get_event_loop().remove_reader(self.fd)
+        os.close(self.fd)
+
+
+class PollWatcher(object):
+    """Calls changed(kind, folder) for every object folder whose files
+    changed size or mtime, looking every interval seconds. Works
+    everywhere, for when there is no inotify
+    """
+
+    def __init__(self, ctx, changed, interval):
+        self.ctx = ctx
+        self.changed = changed
+        self.interval = interval
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        ctx = self.ctx
+        seen = await run_blocking(ctx, folder_stats, ctx.sync_path)
+        while True:
+            await asyncio.sleep(self.interval)
+            now = await run_blocking(ctx, folder_stats, ctx.sync_path)
+            for key in sorted(set(seen) | set(now)):
+                if seen.get(key) != now.get(key):
+                    self.changed(*key)
+            seen = now
+
+    def stop(self):
+        self.task.cancel()
+
+
+def folder_stats(sync_path):
+    """(kind, folder) -> sorted (name, size, mtime) of the files of every
+    object folder, for PollWatcher to compare
+    """
+    stats = {}
+    for rtype in RESOURCE_TYPES:
+        for folder in list_folders(join(sync_path, rtype.folder)):
+            try:
+                stats[rtype.folder, folder] = sorted(
+                    (f.name, f.stat().st_size, f.stat().st_mtime_ns)
+                    for f in os.scandir(join(sync_path, rtype.folder, folder))
+                    if f.is_file()
+                )
+            except FileNotFoundError:
+                continue
+    return stats
+
+
+def folder_watcher(ctx, changed):
+    """InotifyWatcher where there is inotify, PollWatcher elsewhere"""
     try:
-        with open(
-            join(sync_path, "extension_attributes", ext_attr, xml_file[0]), "r"
-        ) as file:
-            template = ET.fromstring(file.read())
-    except IndexError:
-        with async_timeout.timeout(args.timeout):
-            headers = {
-                "Accept": "application/xml",
-                "Content-Type": "application/xml",
-                "Authorization": "Bearer " + token,
+        return InotifyWatcher(ctx, changed)
+    except (AttributeError, OSError) as e:
+        LOG.info("No inotify (%s), polling every %ss", e, ctx.args.debounce)
+        return PollWatcher(ctx, changed, ctx.args.debounce)
+
+
+class Agent(object):
+    """Keeps a Syncer warm for --agent, with its session, API tokens,
+    limits and manifest. Edits to the object folders are collected as they
+    happen and synced once they have been quiet for --debounce seconds.
+    Commands on the control socket are synced right away:
+
+        sync                  what changed in git, as a run without --agent
+        sync scripts/Foo ...  just these folders, as they are in the
+                              working tree
+        status                whether a sync is running, what is queued and
+                              the results of the last sync
+
+    Folder names with spaces are quoted as in a shell. Every command is
+    answered with a line of JSON as soon as it is queued, so clients never
+    wait for the JSS. With --webhook the agent follows the pushes of
+    WebhookReceiver instead of watching the working tree. Syncs never
+    overlap
+    """
+
+    def __init__(self, syncer, socket_path):
+        self.syncer = syncer
+        self.socket_path = socket_path
+        self.debounce = syncer.ctx.args.debounce
+        # What the next sync covers: a run of the git changes when full is
+        # set and the folders in pending
+        self.full = False
+        self.pending = set()
+        # (before, after) of the pushes received since the last sync, see
+        # WebhookReceiver
+        self.pushes = []
+        # Loop time of the last edit, and whether a command asked for the
+        # next sync to start without waiting for the edits to go quiet
+        self.last_edit = 0.0
+        self.urgent = False
+        self.wakeup = asyncio.Event()
+        self.running = False
+        self.syncs = 0
+        self.sync_seconds = 0.0
+        self.last = None
+
+    def edited(self, kind, folder):
+        self.pending.add((kind, folder))
+        self.last_edit = asyncio.get_event_loop().time()
+        self.wakeup.set()
+
+    def pushed(self, before, after):
+        if (before, after) not in self.pushes:
+            self.pushes.append((before, after))
+        self.last_edit = asyncio.get_event_loop().time()
+        self.wakeup.set()
+
+    def request(self, folders=None):
+        if folders is None:
+            self.full = True
+        else:
+            self.pending.update(folders)
+        self.urgent = True
+        self.wakeup.set()
+
+    async def run(self, stopped):
+        """Serves until stopped is done, starting with a run that catches up
+        on what was committed while the agent wasn't running
+        """
+        os.makedirs(dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            # Left behind by an agent that was killed
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        receiver = watcher = None
+        try:
+            if self.syncer.ctx.args.webhook:
+                receiver = WebhookReceiver(self)
+                await receiver.start()
+            else:
+                watcher = folder_watcher(self.syncer.ctx, self.edited)
+                watcher.start()
+            LOG.info("Agent listening on %s", self.socket_path)
+            self.request()
+            worker = asyncio.ensure_future(self.work())
+            try:
+                await stopped
+            finally:
+                worker.cancel()
+        finally:
+            if watcher is not None:
+                watcher.stop()
+            if receiver is not None:
+                await receiver.stop()
+            server.close()
+            await server.wait_closed()
+            os.remove(self.socket_path)
+
+    async def work(self):
+        while True:
+            await self.settle()
+            full, folders, pushes = self.full, self.pending, self.pushes
+            self.full, self.pending, self.pushes = False, set(), []
+            self.urgent = False
+            self.running = True
+            try:
+                if pushes and await self.follow(pushes):
+                    full = True
+                if full:
+                    await self.sync()
+                if folders:
+                    await self.sync(folders)
+            finally:
+                self.running = False
+
+    async def settle(self):
+        """Waits for something to sync, then for the edits to go quiet"""
+        loop = asyncio.get_event_loop()
+        await self.wakeup.wait()
+        while not self.urgent:
+            self.wakeup.clear()
+            quiet = loop.time() - self.last_edit
+            if quiet >= self.debounce:
+                break
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.debounce - quiet)
+            except asyncio.TimeoutError:
+                pass
+        self.wakeup.clear()
+
+    async def follow(self, pushes):
+        """Fetches pushes and fast-forwards the checkout to them, returning
+        whether it moved to any of them. A push that can't be fast-forwarded
+        to, such as a force push, is left out and logged
+        """
+        ctx = self.syncer.ctx
+        LOG.info("Following %d pushes up to %s", len(pushes), pushes[-1][1][:12])
+        try:
+            await git(ctx, "fetch", "--quiet", ctx.args.webhook_remote)
+        except subprocess.CalledProcessError as e:
+            LOG.error("Can't fetch the pushes: %s", e.stderr.decode().strip())
+            self.last = {"error": e.stderr.decode().strip()}
+            return False
+        followed = False
+        # In the order they came, so a push delivered late is a no-op
+        for _, after in pushes:
+            try:
+                await git(ctx, "merge", "--ff-only", "--quiet", after)
+                followed = True
+            except subprocess.CalledProcessError as e:
+                LOG.error("Can't follow %s: %s", after[:12], e.stderr.decode().strip())
+        return followed
+
+    async def sync(self, folders=None):
+        started = time.monotonic()
+        try:
+            self.last = await self.syncer.run(folders)
+        except Exception as e:  # pylint: disable=broad-except
+            # The agent outlives a failed sync, the next one tries again
+            LOG.error("Sync failed: %r", e)
+            self.last = {"error": repr(e)}
+            return
+        finally:
+            self.syncs += 1
+            self.sync_seconds = time.monotonic() - started
+        print_failure_summary(self.syncer.ctx)
+        LOG.info("Synced in %.2fs", time.monotonic() - started)
+
+    async def handle(self, reader, writer):
+        try:
+            line = await reader.readline()
+            try:
+                words = shlex.split(line.decode("utf-8", "replace"))
+            except ValueError as e:
+                reply = {"error": str(e)}
+            else:
+                reply = self.command(words)
+            writer.write((json.dumps(reply) + "\n").encode("utf-8"))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def command(self, words):
+        if words == ["status"]:
+            return {
+                "running": self.running,
+                "syncs": self.syncs,
+                "queued": self.queued(),
+                "last": self.last,
             }
+        if words[:1] != ["sync"]:
+            return {"error": "Unknown command: %s" % " ".join(words)}
+        if words[1:] in ([], ["now"]):
+            self.request()
+            return {"queued": self.queued()}
+        folders = []
+        for path in words[1:]:
+            if os.path.isabs(path):
+                path = os.path.relpath(path, self.syncer.ctx.sync_path)
+            folder = object_folder(path.strip("/") + "/")
+            if folder is None:
+                return {"error": "Not an object folder: %s" % path}
+            folders.append(folder)
+        self.request(folders)
+        return {"queued": self.queued()}
 
-            async with session.get(
-                url + "/JSSResource/computerextensionattributes/name/" + ext_attr,
-                headers=headers,
-            ) as resp:
-                if resp.status == 200:
-                    async with session.get(
-                        url
-                        + "/JSSResource/computerextensionattributes/name/"
-                        + ext_attr,
-                        headers=headers,
-                    ) as response:
-                        template = ET.fromstring(await response.text())
-                else:
-                    template = ET.parse(join(sync_path, "templates/ea.xml")).getroot()
-    # name is mandatory, so we use the foldername if nothing is set in
-    # a template
-    if args.verbose:
-        print(ET.tostring(template))
-    if template.find("category") and template.find("category").text not in CATEGORIES:
-        ET.SubElement(template, "category").text = "None"
-        if args.verbose:
-            c = template.find("category").text
-            print(
-                f"""WARNING: Unable to find category {c} in the JSS,
-                  setting to None"""
+    def queued(self):
+        return (
+            ["push %s" % after[:12] for _, after in self.pushes]
+            + (["changes"] if self.full else [])
+            + sorted("%s/%s" % key for key in self.pending)
+        )
+
+
+class WebhookReceiver(object):
+    """HTTP endpoint of --webhook for the push events of GitHub, GitLab,
+    Gitea and the like, or anything else that POSTs JSON with ref, before
+    and after. Pushes to the branch checked out at sync_path are queued
+    with the agent and answered with 202. The agent fetches them together
+    once they have been quiet for --debounce seconds and syncs the lot in
+    one run from the last synced commit, so an object several pushes
+    touched is uploaded once. With --webhook_secret only signed requests
+    are taken. More than --webhook_queue pushes waiting are turned away
+    with a 503 and a Retry-After of what the last sync took, which backs
+    senders off while the JSS is slow
+    """
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.args = agent.syncer.ctx.args
+        self.branch = None
+        self.runner = None
+
+    async def start(self):
+        out = await git(self.agent.syncer.ctx, "symbolic-ref", "HEAD")
+        self.branch = out.decode("utf-8").strip()
+        app = web.Application()
+        app.router.add_post("/{path:.*}", self.receive)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        host, port = self.args.webhook
+        await web.TCPSite(self.runner, host, port).start()
+        LOG.info("Taking pushes to %s on %s:%d", self.branch, host or "*", port)
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def receive(self, request):
+        body = await request.read()
+        if not webhook_signed(self.args.webhook_secret, request.headers, body):
+            return web.json_response({"error": "Bad signature"}, status=401)
+        try:
+            push = json.loads(body.decode("utf-8"))
+            ref, before, after = push["ref"], push["before"], push["after"]
+            push_shas = (before, after)
+        except (ValueError, KeyError, TypeError):
+            return web.json_response({"error": "Not a push event"}, status=400)
+        if not all(re.match(r"[0-9a-f]{40,64}$", str(sha)) for sha in push_shas):
+            return web.json_response({"error": "Not a commit hash"}, status=400)
+        if ref != self.branch or not after.strip("0"):
+            # Other branches, and the deletion of this one
+            return web.json_response({"ignored": ref}, status=202)
+        agent = self.agent
+        if len(agent.pushes) >= self.args.webhook_queue:
+            return web.json_response(
+                {"error": "Too many pushes waiting"},
+                status=503,
+                headers={"Retry-After": "%d" % (agent.sync_seconds + 1)},
             )
-    if template.find("name") is None:
-        ET.SubElement(template, "name").text = ext_attr
-    elif not template.find("name").text or template.find("name").text is None:
-        template.find("name").text = ext_attr
-    return template
+        agent.pushed(before, after)
+        return web.json_response({"queued": agent.queued()}, status=202)
 
 
-async def upload_scripts(session, url, user, passwd, semaphore):
-    # sync_path = dirname(realpath(__file__))
+def webhook_signed(secret, headers, body):
+    """Checks the signature GitHub and Gitea send, or the token GitLab
+    sends, against --webhook_secret. Without a secret everything passes
+    """
+    if not secret:
+        return True
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    for header, expected in (
+        ("X-Hub-Signature-256", "sha256=" + digest),
+        ("X-Gitea-Signature", digest),
+        ("X-Gitlab-Token", secret),
+    ):
+        if header in headers and hmac.compare_digest(
+            headers[header].encode("utf-8"), expected.encode("utf-8")
+        ):
+            return True
+    return False
 
-    if not changed_scripts and not args.update_all:
-        print("No Changes in Scripts")
-    scripts = [
-        f.name
-        for f in os.scandir(join(sync_path, "scripts"))
-        if f.is_dir() and f.name in changed_scripts
-    ]
-    if args.update_all:
-        print("Copying all scripts...")
-        scripts = [f.name for f in os.scandir(join(sync_path, "scripts")) if f.is_dir()]
-
-    tasks = []
-    for script in scripts:
-        task = asyncio.ensure_future(
-            upload_script(session, url, user, passwd, script, semaphore)
+
+async def run_agent(syncer, socket_path):
+    """--agent: serves until SIGINT or SIGTERM"""
+    loop = asyncio.get_event_loop()
+    stopped = loop.create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(
+            signum, lambda: stopped.done() or stopped.set_result(None)
         )
-        tasks.append(task)
-    await asyncio.gather(*tasks)
+    async with syncer:
+        await Agent(syncer, socket_path).run(stopped)
 
 
-async def upload_script(session, url, user, passwd, script, semaphore):
-    # sync_path = dirname(realpath(__file__))
-    # auth = aiohttp.BasicAuth(user, passwd)
-    headers = {
-        "Accept": "application/xml",
-        "Content-Type": "application/xml",
-        "Authorization": "Bearer " + token,
-    }
-    script_file = [
-        f.name
-        for f in os.scandir(join(sync_path, "scripts", script))
-        if f.is_file() and f.name.split(".")[-1] in SUPPORTED_SCRIPT_EXTENSIONS
-    ]
-    if script_file == []:
-        print("Warning: No script file found in scripts/%s" % script)
-        return  # Need to skip if no script.
-    with open(join(sync_path, "scripts", script, script_file[0]), "r") as f:
-        data = f.read()
-    async with semaphore:
-        with async_timeout.timeout(args.timeout):
-            template = await get_script_template(session, url, user, passwd, script)
-            async with session.get(
-                url + "/JSSResource/scripts/name/" + template.find("name").text,
-                headers=headers,
-            ) as resp:
-                template.find("script_contents").text = data
-                if resp.status == 200:
-                    put_url = (
-                        url + "/JSSResource/scripts/name/" + template.find("name").text
-                    )
-                    resp = await session.put(
-                        put_url, data=ET.tostring(template), headers=headers
-                    )
-                else:
-                    post_url = url + "/JSSResource/scripts/id/0"
-                    resp = await session.post(
-                        post_url, data=ET.tostring(template), headers=headers
-                    )
-    if resp.status in (201, 200):
-        print("Uploaded script: %s" % template.find("name").text)
-    else:
-        print("Error uploading script: %s" % template.find("name").text)
-        print("Error: %s" % resp.status)
-    return resp.status
-
-
-async def get_script_template(session, url, user, passwd, script):
-    # auth = aiohttp.BasicAuth(user, passwd)
-    # sync_path = dirname(realpath(__file__))
-    xml_file = [
-        f.name
-        for f in os.scandir(join(sync_path, "scripts", script))
-        if f.is_file() and f.name.split(".")[-1] in "xml"
-    ]
+def agent_running(socket_path):
+    """Whether an agent answers on socket_path"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        with open(join(sync_path, "scripts", script, xml_file[0]), "r") as file:
-            template = ET.fromstring(file.read())
-    except IndexError:
-        with async_timeout.timeout(args.timeout):
-            headers = {
-                "Accept": "application/xml",
-                "Content-Type": "application/xml",
-                "Authorization": "Bearer " + token,
-            }
-            async with session.get(
-                url + "/JSSResource/scripts/name/" + script, headers=headers
-            ) as resp:
-                if resp.status == 200:
-                    async with session.get(
-                        url + "/JSSResource/scripts/name/" + script, headers=headers
-                    ) as response:
-                        template = ET.fromstring(await response.text())
-                else:
-                    template = ET.parse(
-                        join(sync_path, "templates/script.xml")
-                    ).getroot()
-    # name is mandatory, so we use the filename if nothing is set in a template
-    if args.verbose:
-        print(ET.tostring(template))
-    if (
-        template.find("category") is not None
-        and template.find("category").text not in CATEGORIES
-    ):
-        c = template.find("category").text
-        template.remove(template.find("category"))
-        if args.verbose:
-            print(
-                f"""WARNING: Unable to find category "{c}" in the JSS,
-                    setting to None"""
-            )
-    if template.find("name") is None:
-        ET.SubElement(template, "name").text = script
-    elif not template.find("name").text or template.find("name").text is None:
-        template.find("name").text = script
-    return template
+        sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
 
 
-async def get_existing_categories(session, url, user, passwd, semaphore):
-    # auth = aiohttp.BasicAuth(user, passwd)
-    headers = {
-        "Accept": "application/xml",
-        "Content-Type": "application/xml",
-        "Authorization": "Bearer " + token,
-    }
-    async with semaphore:
-        with async_timeout.timeout(args.timeout):
-            async with session.get(
-                url + "/JSSResource/categories", headers=headers
-            ) as resp:
-                if resp.status in (201, 200):
-                    return [
-                        c.find("name").text
-                        for c in [
-                            e
-                            for e in ET.fromstring(await resp.text()).findall(
-                                "category"
-                            )
-                        ]
-                    ]
-    return []
-
-
-async def main():
-    # pylint: disable=global-statement
-    global CATEGORIES
-    semaphore = asyncio.BoundedSemaphore(args.limit)
-    async with aiohttp.ClientSession() as session:
-        async with aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(ssl=args.do_not_verify_ssl)
-        ) as session:
-            CATEGORIES = await get_existing_categories(
-                session, url, username, password, semaphore
+def send_command(socket_path, command):
+    """--send: hands command to the agent listening on socket_path and
+    prints its answer
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((command + "\n").encode("utf-8"))
+        reply = sock.makefile("r", encoding="utf-8").readline()
+    except OSError as e:
+        print("No agent on %s: %s" % (socket_path, e))
+        return 1
+    finally:
+        sock.close()
+    print(reply.rstrip("\n"))
+    return 1 if not reply or "error" in json.loads(reply) else 0
+
+
+async def main(syncer):
+    args = syncer.ctx.args
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.monotonic()
+    try:
+        async with syncer:
+            results = await syncer.run()
+    finally:
+        monitor.stop()
+    print_failure_summary(syncer.ctx)
+    if args.stats_file:
+        write_stats_file(syncer.ctx, args.stats_file, time.monotonic() - started)
+    if (args.results_file or args.shard) and not args.plan:
+        write_results_file(
+            args.results_file or "results-%d-of-%d.json" % args.shard, results
+        )
+
+
+async def sync(ctx, session):
+    args = ctx.args
+    # git runs while the indexes are fetched
+    changes = asyncio.ensure_future(
+        asyncio.gather(*[check_for_changes(target) for target in ctx.targets])
+    )
+    if not ctx.manifest:
+        ctx.manifest = await run_blocking(ctx, load_manifest, ctx)
+    # One scan of the repo, fanned out to every target
+    scan = Fanout(scan_resource_types(ctx))
+    targets = asyncio.gather(
+        *[sync_target(session, target, changes, scan) for target in ctx.targets]
+    )
+    try:
+        await changes
+        print("Changed Extension Attributes: ", ctx.changed_ext_attrs)
+        print("Changed Scripts: ", ctx.changed_scripts)
+        # Shards leave the jenkins file to --merge
+        if args.jenkins and not (args.plan or args.drift or args.shard):
+            await run_blocking(
+                ctx, write_jenkins_file, ctx.changed_ext_attrs, ctx.changed_scripts
             )
-            await upload_scripts(session, url, username, password, semaphore)
-            await upload_extension_attributes(
-                session, url, username, password, semaphore
+    finally:
+        await targets
+    if args.plan:
+        for target in ctx.targets:
+            print_plan(target)
+    else:
+        save_manifest(ctx)
+    if args.drift:
+        for target in ctx.targets:
+            print_drift(target)
+
+
+async def sync_target(session, target, changes, scan):
+    """Syncs the repo to one target: fetches its indexes and categories,
+    or restores them from the --plan snapshot, loads or rebuilds its
+    ledger and uploads what changed since its last synced commit. Errors
+    are recorded against the target so the others carry on
+    """
+    args = target.ctx.args
+    target.nodes.start(session)
+    try:
+        snapshot = None
+        if args.use_snapshot:
+            snapshot = await run_blocking(target.ctx, load_snapshot, target)
+        if snapshot:
+            restore_snapshot(target, snapshot)
+        else:
+            (
+                target.categories,
+                target.script_index,
+                target.ea_index,
+            ) = await asyncio.gather(
+                get_existing_categories(session, target),
+                get_resource_index(session, target, "scripts"),
+                get_resource_index(session, target, "computerextensionattributes"),
             )
+        await asyncio.shield(changes)
+        if args.drift:
+            await drift_target(session, target, scan)
+            return
+        if args.plan:
+            target.log("Fetching remote scripts and extension attributes...")
+            await fetch_snapshot(session, target)
+            await run_blocking(target.ctx, save_snapshot, target)
+            await upload_all(session, target, scan, plan=True)
+            return
+        if args.verify_remote or snapshot:
+            # A snapshot is as good as a fresh remote fetch, so the sync
+            # sends exactly what the plan showed
+            target.log("Rebuilding sync ledger from the JSS...")
+            target.ledger = await rebuild_ledger(session, target)
+        else:
+            target.ledger = await run_blocking(target.ctx, load_ledger, target)
+        open_journal(target)
+        try:
+            await upload_all(session, target, scan)
+            if not target.failed:
+                await save_watermark(target)
+        finally:
+            save_ledger(target)
+            close_journal(target)
+            if any(target.stats[key] for key in ("uploaded", "renamed", "deleted")):
+                # What --drift cached of the JSS is out of date now
+                forget_remote_digests(target)
+            target.limiter.report()
+    except Exception as e:  # pylint: disable=broad-except
+        print("Error syncing to %s: %r" % (target.name, e))
+        target.failed.append(("server", target.name, repr(e)))
+    finally:
+        target.nodes.stop()
 
 
-if __name__ == "__main__":
-    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+def config_target(syncer, confparser, section):
+    """Adds the target for a section of the config file, which has the
+    server, username and password of one JSS and optionally its own limit,
+    min_limit and max_limit and the other nodes of its cluster
+    """
+    if not confparser.has_section(section):
+        sys.exit("Can't find [%s] in the config file" % section)
+    conf = confparser[section]
+    target_password = conf.get("password") or getpass.getpass(
+        "Password for %s: " % section
+    )
+    return syncer.add_target(
+        conf["server"],
+        conf["username"],
+        target_password,
+        conf.getint("limit"),
+        conf.getint("min_limit"),
+        conf.getint("max_limit"),
+        conf.get("nodes", "").split(),
+    )
 
-    # Export to current directory by default
-    sync_path = dirname(realpath(__file__))
 
+def build_parser():
     parser = argparse.ArgumentParser(description="Sync repo with JamfPro")
     parser.add_argument("--url")
     parser.add_argument("--username")
     parser.add_argument("--password")
+    parser.add_argument(
+        "--target", action="append"
+    )  # Config file section of a JSS to sync to, repeat for several
     parser.add_argument("--sync_path")
-    parser.add_argument("--limit", type=int, default=25)
+    parser.add_argument("--limit", type=int, default=25)  # Starting concurrency
+    parser.add_argument("--min_limit", type=int, default=2)
+    parser.add_argument("--max_limit", type=int, default=100)
+    parser.add_argument(
+        "--hedge_percentile", type=float
+    )  # e.g. 0.95, GETs slower than this percentile of the run get a second copy
+    parser.add_argument(
+        "--hedge_budget", type=float, default=0.05
+    )  # Most hedged GETs as a fraction of all GETs
+    parser.add_argument(
+        "--latency_tolerance", type=float, default=2.0
+    )  # Latency over the best seen, as a factor, that counts as congestion
+    parser.add_argument(
+        "--node", action="append", default=[]
+    )  # Base URL of another node of a clustered JSS to spread requests over
+    parser.add_argument(
+        "--pin_writes", action="store_true"
+    )  # Sends everything but GETs to the --url node
+    parser.add_argument(
+        "--eject_seconds", type=int, default=30
+    )  # How long a node that timed out or answered 5xx gets no requests
+    parser.add_argument(
+        "--health_interval", type=int, default=10
+    )  # Seconds between health checks of the nodes
     parser.add_argument("--timeout", type=int, default=60)
+    parser.add_argument("--retries", type=int, default=4)  # GET/PUT retries
+    parser.add_argument("--post_retries", type=int, default=2)
+    parser.add_argument("--backoff", type=float, default=0.5)  # First retry delay
+    parser.add_argument("--max_backoff", type=float, default=30)
+    parser.add_argument(
+        "--queue_size", type=int, default=100
+    )  # Objects waiting between two stages of the upload pipeline
+    parser.add_argument(
+        "--io_workers", type=int, default=4
+    )  # Workers reading files and building templates
+    parser.add_argument(
+        "--executor_workers", type=int, default=8
+    )  # Threads for file, git and XML work off the event loop
     parser.add_argument("--verbose", action="store_true")
     parser.add_argument("--do_not_verify_ssl", action="store_false")
     parser.add_argument("--update_all", action="store_true")
+    parser.add_argument(
+        "--max_deletes", type=int, default=25
+    )  # Most objects one run may delete from the JSS
     parser.add_argument("--jenkins", action="store_true")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--state_dir", default=os.path.expanduser("~/.git2jss")
+    )  # Per-server sync state such as the ledger
+    parser.add_argument(
+        "--verify_remote", "--verify-remote", action="store_true"
+    )  # Rebuilds the ledger from the JSS
+    parser.add_argument(
+        "--token_refresh", type=int, default=300
+    )  # Seconds before expiry at which the API token is renewed
+    parser.add_argument(
+        "--token_cache", action="store_true"
+    )  # Keeps the API token in state_dir between runs
+    parser.add_argument(
+        "--plan", action="store_true"
+    )  # Shows what would be uploaded without changing the JSS
+    parser.add_argument(
+        "--drift", action="store_true"
+    )  # Reports objects that differ between the repo and the JSS, changes nothing
+    parser.add_argument(
+        "--drift_max_age", type=int, default=300
+    )  # Seconds --drift reuses the digest of a remote object it fetched
+    parser.add_argument(
+        "--use_snapshot", action="store_true"
+    )  # Uses the remote objects fetched by the last --plan
+    parser.add_argument("--snapshot_max_age", type=int, default=3600)
+    parser.add_argument(
+        "--resume", action="store_true"
+    )  # Skips the objects a killed run already synced, see state_dir/journal
+    parser.add_argument(
+        "--category_ttl", type=int, default=3600
+    )  # Seconds the category list of the JSS is cached in state_dir
+    parser.add_argument(
+        "--stats_file"
+    )  # Writes counters and per-object latencies of the run as JSON
+    parser.add_argument(
+        "--shard", type=shard_spec
+    )  # i/N, syncs only the i-th of N stable slices of the repo
+    parser.add_argument(
+        "--results_file"
+    )  # What was synced and what failed, default results-i-of-N.json with --shard
+    parser.add_argument(
+        "--merge", nargs="+", metavar="RESULTS_FILE"
+    )  # Combines the results of all shards into one report and jenkins file
+    parser.add_argument(
+        "--agent", action="store_true"
+    )  # Stays running, syncs edits as they happen and takes commands, see Agent
+    parser.add_argument(
+        "--agent_socket"
+    )  # Control socket of the agent, default state_dir/agent.sock
+    parser.add_argument(
+        "--debounce", type=float, default=2.0
+    )  # Seconds edits must be quiet before the agent syncs them
+    parser.add_argument(
+        "--send", nargs="+", metavar="WORD"
+    )  # Sends a command such as "sync" or "status" to the agent and exits
+    parser.add_argument(
+        "--webhook", type=webhook_spec
+    )  # [host:]port, runs the agent on git push webhooks, see WebhookReceiver
+    parser.add_argument("--webhook_secret")  # Signs or authenticates the pushes
+    parser.add_argument(
+        "--webhook_remote", default="origin"
+    )  # Remote the pushed commits are fetched from
+    parser.add_argument(
+        "--webhook_queue", type=int, default=100
+    )  # Most pushes waiting before the webhook answers 503
+    return parser
+
+
+def cli(argv=None):
+    """The command line: parses the flags and the config file, syncs once
+    with a Syncer and returns the exit status
+    """
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(levelname)7s: %(message)s",
+        stream=sys.stderr,
+    )
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # Export to current directory by default
+    sync_path = dirname(realpath(__file__))
 
-    changed_ext_attrs = []
-    changed_scripts = []
-    check_for_changes()
-    print("Changed Extension Attributes: ", changed_ext_attrs)
-    print("Changed Scripts: ", changed_scripts)
+    args = build_parser().parse_args(argv)
 
-    if args.jenkins:
-        write_jenkins_file()
+    if args.merge:
+        return merge_results(args.merge)
+    socket_path = args.agent_socket or join(args.state_dir, "agent.sock")
+    if args.webhook:
+        args.agent = True
+    if args.send:
+        return send_command(
+            socket_path, " ".join(shlex.quote(word) for word in args.send)
+        )
+    if args.agent and args.plan:
+        sys.exit("--agent can't be combined with --plan")
+    if args.drift and (args.plan or args.shard or args.agent):
+        sys.exit("--drift can't be combined with --plan, --shard or --agent")
+    if args.agent and agent_running(socket_path):
+        sys.exit("An agent is already running on %s" % socket_path)
+    url = username = password = None
     # Set configs file locations
-    CONFIG_FILE_LOCATIONS = ["jamfapi.cfg", os.path.expanduser("~/jamfapi.cfg")]
-    CONFIG_FILE = ""
+    config_file_locations = ["jamfapi.cfg", os.path.expanduser("~/jamfapi.cfg")]
+    config_file = ""
     # Parse Config File
-    CONFPARSER = configparser.ConfigParser()
-    for config_path in CONFIG_FILE_LOCATIONS:
+    confparser = configparser.ConfigParser()
+    for config_path in config_file_locations:
         if os.path.exists(config_path):
             print("Found Config: {0}".format(config_path))
-            CONFIG_FILE = config_path
+            config_file = config_path
 
-    if CONFIG_FILE != "":
+    if config_file != "":
         try:
             # Get config
-            CONFPARSER.read(CONFIG_FILE)
+            confparser.read(config_file)
         except:
             print("Can't read config file")
         try:
-            username = CONFPARSER.get("jss", "username")
+            username = confparser.get("jss", "username")
         except:
             print("Can't find username in configfile")
         try:
-            password = CONFPARSER.get("jss", "password")
+            password = confparser.get("jss", "password")
         except:
             print("Can't find password in configfile")
         try:
-            url = CONFPARSER.get("jss", "server")
+            url = confparser.get("jss", "server")
         except:
             print("Can't find url in configfile")
         try:
-            sync_path = CONFPARSER.get("jss", "sync_path")
+            sync_path = confparser.get("jss", "sync_path")
         except:
             print("Can't find sync_path in config")
 
     # Ask for password if not supplied via command line args
     if args.password:
         password = args.password
-    elif password is None:
+    elif password is None and not args.target:
         password = getpass.getpass()
 
     if args.sync_path:
@@ -527,13 +3215,33 @@ if __name__ == "__main__":
     if args.username:
         username = args.username
 
-    token = get_uapi_token()
-
-    loop = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
 
     if args.verbose:
         loop.set_debug(True)
         loop.slow_callback_duration = 0.001
         warnings.simplefilter("always", ResourceWarning)
 
-    loop.run_until_complete(main())
+    syncer = Syncer(sync_path, args)
+    if args.target:
+        for section in args.target:
+            config_target(syncer, confparser, section)
+    else:
+        syncer.add_target(url, username, password, nodes=args.node)
+
+    if args.agent:
+        loop.run_until_complete(run_agent(syncer, socket_path))
+        return 0
+    loop.run_until_complete(main(syncer))
+    if any(target.failed for target in syncer.ctx.targets):
+        return 1
+    if args.plan and plan_has_changes(syncer.ctx):
+        return 2
+    if args.drift and drift_found(syncer.ctx):
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of sync.py and tools/download.py against the local
+MockJSS. For every repo size it generates a synthetic repo with that many
+script and extension attribute folders and measures:
+
+    sync_cold  sync.py --update_all against an empty JSS
+    sync_warm  the same sync again, where the ledger skips everything
+    download   tools/download.py of everything back out of the JSS
+
+and reports objects/sec, request count, peak RSS and p50/p99 per-object
+latency. Results are compared with a stored baseline and any metric that
+got worse by more than --tolerance fails the run.
+
+Usage:
+    ./tools/benchmark/benchmark.py --sizes 10,1000
+    ./tools/benchmark/benchmark.py --update_baseline
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import dirname, join, realpath
+
+from mock_jss import MockJSS
+
+REPO = realpath(join(dirname(realpath(__file__)), "..", ".."))
+BASELINE = join(dirname(realpath(__file__)), "baseline.json")
+# metric -> True when higher is better
+METRICS = {
+    "objects_per_sec": True,
+    "requests": False,
+    "peak_rss_mb": False,
+    "latency_p50": False,
+    "latency_p99": False,
+}
+
+
+def generate_repo(path, size):
+    """Creates size script and size EA folders, each with its XML"""
+    for i in range(size):
+        name = "Bench Script %05d" % i
+        folder = join(path, "scripts", name)
+        os.makedirs(folder)
+        with open(join(folder, "script.sh"), "w") as f:
+            f.write("#!/bin/sh\n# %s\necho %d\n" % (name, i) + "true\n" * (i % 50))
+        with open(join(folder, "script.xml"), "w") as f:
+            f.write(
+                "<script><name>%s</name><info/><notes/><priority>After</priority>"
+                "<parameters/><os_requirements/><script_contents/></script>" % name
+            )
+        name = "Bench EA %05d" % i
+        folder = join(path, "extension_attributes", name)
+        os.makedirs(folder)
+        with open(join(folder, "ea.sh"), "w") as f:
+            f.write('#!/bin/sh\necho "<result>%d</result>"\n' % i)
+        with open(join(folder, "ea.xml"), "w") as f:
+            f.write(
+                "<computer_extension_attribute><name>%s</name><enabled>true</enabled>"
+                "<description/><data_type>String</data_type><input_type>"
+                "<type>script</type><platform>Mac</platform><script/></input_type>"
+                "<inventory_display>General</inventory_display>"
+                "</computer_extension_attribute>" % name
+            )
+    # sync.py compares the last two commits unless --jenkins is given
+    for message in ("first", "second"):
+        subprocess.check_call(
+            [
+                "git",
+                "-c",
+                "user.name=benchmark",
+                "-c",
+                "user.email=benchmark@localhost",
+                "commit",
+                "-q",
+                "--allow-empty",
+                "-m",
+                message,
+            ],
+            cwd=path,
+        )
+
+
+def wait(pid):
+    """Waits for pid and returns its exit code and peak RSS in MB"""
+    _, status, rusage = os.wait4(pid, 0)
+    code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return code, rusage.ru_maxrss / scale
+
+
+async def run(jss, command, cwd):
+    """Runs command while jss keeps serving and returns its measurements"""
+    before = sum(jss.requests.values())
+    started = time.monotonic()
+    with open(join(cwd, "output.log"), "a") as log:
+        proc = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=log)
+        code, rss = await asyncio.get_event_loop().run_in_executor(None, wait, proc.pid)
+    proc.returncode = code
+    return {
+        "exit_code": code,
+        "elapsed": time.monotonic() - started,
+        "requests": sum(jss.requests.values()) - before,
+        "peak_rss_mb": round(rss, 1),
+    }
+
+
+async def bench_size(args, size):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="git2jss-bench-") as tmp:
+        repo = join(tmp, "repo")
+        subprocess.check_call(["git", "init", "-q", repo])
+        generate_repo(repo, size)
+        jss = MockJSS(
+            args.latency,
+            args.jitter,
+            args.error_rate,
+            args.server_concurrency,
+            seed=size,
+        )
+        url = await jss.start()
+        credentials = ["--url", url, "--username", "bench", "--password", "bench"]
+        try:
+            for phase in ("sync_cold", "sync_warm"):
+                stats_file = join(tmp, phase + ".json")
+                result = await run(
+                    jss,
+                    [sys.executable, join(REPO, "sync.py")]
+                    + credentials
+                    + [
+                        "--sync_path",
+                        repo,
+                        "--state_dir",
+                        join(tmp, "state"),
+                        "--update_all",
+                        "--stats_file",
+                        stats_file,
+                    ]
+                    + args.sync_args,
+                    repo,
+                )
+                with open(stats_file) as f:
+                    stats = json.load(f)
+                result["objects_per_sec"] = stats["objects"] / result["elapsed"]
+                result["latency_p50"] = stats["latency_p50"]
+                result["latency_p99"] = stats["latency_p99"]
+                results[phase] = result
+            result = await run(
+                jss,
+                [sys.executable, join(REPO, "tools", "download.py")]
+                + credentials
+                + ["--export_path", join(tmp, "export")],
+                tmp,
+            )
+            result["objects_per_sec"] = 2 * size / result["elapsed"]
+            results["download"] = result
+        finally:
+            await jss.stop()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints results next to baseline and returns the regressions"""
+    regressions = []
+    print(
+        "%-16s %12s %10s %10s %10s %10s  %s"
+        % ("run", "objects/sec", "requests", "rss MB", "p50 s", "p99 s", "exit")
+    )
+    for key, result in sorted(results.items()):
+        print(
+            "%-16s %12.1f %10d %10.1f %10s %10s  %d"
+            % (
+                key,
+                result["objects_per_sec"],
+                result["requests"],
+                result["peak_rss_mb"],
+                "%.4f" % result["latency_p50"] if "latency_p50" in result else "-",
+                "%.4f" % result["latency_p99"] if "latency_p99" in result else "-",
+                result["exit_code"],
+            )
+        )
+        for metric, higher_is_better in METRICS.items():
+            if metric not in result or metric not in baseline.get(key, {}):
+                continue
+            old, new = baseline[key][metric], result[metric]
+            if higher_is_better:
+                worse = new < old * (1 - tolerance)
+            else:
+                worse = new > old * (1 + tolerance) and new - old > 1e-3
+            if worse:
+                regressions.append((key, metric, old, new))
+    for key, metric, old, new in regressions:
+        print("REGRESSION %s %s: %.4f -> %.4f" % (key, metric, old, new))
+    return regressions
+
+
+async def main(args):
+    results = {}
+    for size in args.sizes:
+        print("Benchmarking %d script and %d EA folders..." % (size, size))
+        for phase, result in (await bench_size(args, size)).items():
+            results["%s/%d" % (phase, size)] = result
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark git2jss")
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[10, 1000, 10000],
+    )
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--server_concurrency", type=int, default=50)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update_baseline", action="store_true")
+    parser.add_argument(
+        "--sync_args", nargs=argparse.REMAINDER, default=[]
+    )  # Passed on to sync.py, e.g. --sync_args --limit 10
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = loop.run_until_complete(main(args))
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {}
+    params = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "error_rate": args.error_rate,
+        "server_concurrency": args.server_concurrency,
+    }
+    if baseline and baseline.get("params") != params:
+        print("Warning: baseline was recorded with %s" % baseline.get("params"))
+    regressions = compare(results, baseline.get("results", {}), args.tolerance)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {"params": params, "results": results}, f, indent=1, sort_keys=True
+            )
+        print("Baseline written to %s" % args.baseline)
+    elif regressions:
+        sys.exit(1)
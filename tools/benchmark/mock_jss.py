@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Local stand-in for the parts of Jamf Pro that sync.py and download.py
+talk to: the UAPI token endpoints and the Classic API scripts, computer
+extension attributes and categories. Every request can be slowed down,
+made to fail and limited in concurrency, like a busy Tomcat node.
+
+Run it on its own with:
+    ./tools/benchmark/mock_jss.py --port 8443 --latency 0.05 --error_rate 0.01
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import random
+import socket
+import uuid
+from xml.etree import ElementTree as ET
+
+from aiohttp import web
+
+# endpoint -> (list tag, object tag)
+RESOURCES = {
+    "scripts": ("scripts", "script"),
+    "computerextensionattributes": (
+        "computer_extension_attributes",
+        "computer_extension_attribute",
+    ),
+    "categories": ("categories", "category"),
+}
+
+
+class MockJSS(object):
+    def __init__(
+        self, latency=0.0, jitter=0.0, error_rate=0.0, concurrency=0, seed=None
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.concurrency = concurrency
+        self.random = random.Random(seed)
+        self.objects = {resource: {} for resource in RESOURCES}
+        self.requests = collections.Counter()
+        self.next_id = 1
+        self.slots = None
+        self.runner = None
+
+    def add(self, resource, xml):
+        """Stores xml as a new object and returns its id"""
+        obj_id = self.next_id
+        self.next_id += 1
+        tree = ET.fromstring(xml)
+        if tree.find("id") is None:
+            ET.SubElement(tree, "id")
+        tree.find("id").text = str(obj_id)
+        self.objects[resource][obj_id] = ET.tostring(tree, encoding="unicode")
+        return obj_id
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_post("/api/v1/auth/token", self.token)
+        app.router.add_post("/api/v1/auth/keep-alive", self.token)
+        app.router.add_post("/api/v1/auth/invalidate-token", self.invalidate)
+        app.router.add_get("/JSSResource/{resource}", self.listing)
+        app.router.add_route("*", "/JSSResource/{resource}/{key}/{value}", self.object)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Starts serving and returns the base url"""
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        await web.SockSite(self.runner, sock).start()
+        return "http://%s:%d" % sock.getsockname()[:2]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests[request.method] += 1
+        if self.concurrency and self.slots is None:
+            self.slots = asyncio.Semaphore(self.concurrency)
+        if self.slots is None:
+            return await self.handle(request, handler)
+        async with self.slots:
+            return await self.handle(request, handler)
+
+    async def handle(self, request, handler):
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        await asyncio.sleep(max(0.0, delay))
+        if self.random.random() < self.error_rate:
+            return web.Response(status=self.random.choice((502, 503)))
+        return await handler(request)
+
+    async def token(self, request):
+        expires = datetime.datetime.utcnow() + datetime.timedelta(minutes=30)
+        return web.json_response(
+            {
+                "token": uuid.uuid4().hex,
+                "expires": expires.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            }
+        )
+
+    async def invalidate(self, request):
+        return web.Response(status=204)
+
+    async def listing(self, request):
+        resource = request.match_info["resource"]
+        if resource not in RESOURCES:
+            return web.Response(status=404)
+        outer, inner = RESOURCES[resource]
+        root = ET.Element(outer)
+        ET.SubElement(root, "size").text = str(len(self.objects[resource]))
+        for obj_id, xml in self.objects[resource].items():
+            item = ET.SubElement(root, inner)
+            ET.SubElement(item, "id").text = str(obj_id)
+            ET.SubElement(item, "name").text = ET.fromstring(xml).findtext("name")
+        return self.xml(ET.tostring(root, encoding="unicode"))
+
+    async def object(self, request):
+        resource = request.match_info["resource"]
+        if resource not in RESOURCES:
+            return web.Response(status=404)
+        obj_id = self.find(
+            resource, request.match_info["key"], request.match_info["value"]
+        )
+        if request.method == "POST":
+            obj_id = self.add(resource, await request.text())
+            return self.created(resource, obj_id, status=201)
+        if obj_id is None:
+            return web.Response(status=404)
+        if request.method == "GET":
+            return self.xml(self.objects[resource][obj_id])
+        if request.method == "PUT":
+            tree = ET.fromstring(await request.text())
+            if tree.find("id") is None:
+                ET.SubElement(tree, "id")
+            tree.find("id").text = str(obj_id)
+            self.objects[resource][obj_id] = ET.tostring(tree, encoding="unicode")
+            return self.created(resource, obj_id, status=201)
+        if request.method == "DELETE":
+            del self.objects[resource][obj_id]
+            return self.created(resource, obj_id, status=200)
+        return web.Response(status=405)
+
+    def find(self, resource, key, value):
+        if key == "id":
+            return (
+                int(value)
+                if value.isdigit() and int(value) in self.objects[resource]
+                else None
+            )
+        for obj_id, xml in self.objects[resource].items():
+            if ET.fromstring(xml).findtext("name") == value:
+                return obj_id
+        return None
+
+    def created(self, resource, obj_id, status):
+        tag = RESOURCES[resource][1]
+        return self.xml("<%s><id>%d</id></%s>" % (tag, obj_id, tag), status=status)
+
+    @staticmethod
+    def xml(text, status=200):
+        return web.Response(text=text, status=status, content_type="application/xml")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Jamf Pro server")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--latency", type=float, default=0.0)  # Seconds per request
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=0)  # 0 is unlimited
+    args = parser.parse_args()
+    jss = MockJSS(args.latency, args.jitter, args.error_rate, args.concurrency)
+    web.run_app(jss.app(), port=args.port)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Records the HTTP traffic between git2jss and a real Jamf Pro server and
+replays it offline. It runs as a local proxy, so sync.py, tools/download.py
+and aiojss all go through it just by pointing --url at it.
+
+Record against a real server (credentials are scrubbed from the fixtures):
+    ./tools/benchmark/replay_jss.py record --target https://your.jss.url:8443 \\
+        --fixtures jss.jsonl
+    ./sync.py --url http://127.0.0.1:8765 --username api_user --update_all
+
+Replay offline, at the recorded latency or scaled with --latency_scale:
+    ./tools/benchmark/replay_jss.py replay --fixtures jss.jsonl --latency_scale 0.5
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import re
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+# Only these response headers are worth keeping, the rest is noise or
+# session state such as cookies
+KEPT_HEADERS = ("Content-Type", "Retry-After")
+TOKEN = re.compile(r'("token"\s*:\s*")[^"]*(")')
+
+
+def scrub(path, body):
+    """Removes bearer tokens from auth responses"""
+    if path.startswith("/api/v1/auth"):
+        return TOKEN.sub(r"\1REDACTED\2", body)
+    return body
+
+
+class Recorder(object):
+    """Proxies every request to target and appends it to fixtures"""
+
+    def __init__(self, target, fixtures, verify_ssl=True):
+        self.target = target.rstrip("/")
+        self.fixtures = fixtures
+        self.verify_ssl = verify_ssl
+        self.started = time.monotonic()
+        self.session = None
+        self.file = None
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/{path:.*}", self.proxy)
+        app.on_startup.append(self.open)
+        app.on_cleanup.append(self.close)
+        return app
+
+    async def open(self, app):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(ssl=None if self.verify_ssl else False)
+        )
+        self.file = open(self.fixtures, "a")
+
+    async def close(self, app):
+        await self.session.close()
+        self.file.close()
+
+    async def proxy(self, request):
+        body = await request.read()
+        headers = {
+            k: v
+            for k, v in request.headers.items()
+            if k in ("Accept", "Content-Type", "Authorization")
+        }
+        offset = time.monotonic() - self.started
+        async with self.session.request(
+            request.method,
+            self.target + request.path_qs,
+            data=body or None,
+            headers=headers,
+        ) as resp:
+            response_body = await resp.read()
+            elapsed = time.monotonic() - self.started - offset
+            kept = {k: v for k, v in resp.headers.items() if k in KEPT_HEADERS}
+            status = resp.status
+        self.file.write(
+            json.dumps(
+                {
+                    "offset": offset,
+                    "elapsed": elapsed,
+                    "method": request.method,
+                    "path": request.path_qs,
+                    "request_bytes": len(body),
+                    "status": status,
+                    "headers": kept,
+                    "body": scrub(
+                        request.path, response_body.decode("utf-8", "replace")
+                    ),
+                }
+            )
+            + "\n"
+        )
+        self.file.flush()
+        return web.Response(body=response_body, status=status, headers=kept)
+
+
+class Replayer(object):
+    """Answers requests from recorded fixtures. Repeated requests for the
+    same method and path get the recorded responses in order, the last one
+    is reused once they run out. Unknown requests get a 404 and are counted
+    """
+
+    def __init__(self, fixtures, latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self.responses = collections.defaultdict(collections.deque)
+        self.misses = collections.Counter()
+        with open(fixtures) as f:
+            for line in f:
+                fixture = json.loads(line)
+                self.responses[(fixture["method"], fixture["path"])].append(fixture)
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/{path:.*}", self.replay)
+        return app
+
+    async def replay(self, request):
+        await request.read()
+        recorded = self.responses.get((request.method, request.path_qs))
+        if not recorded:
+            self.misses[(request.method, request.path_qs)] += 1
+            return web.Response(status=404)
+        fixture = recorded.popleft() if len(recorded) > 1 else recorded[0]
+        await asyncio.sleep(fixture["elapsed"] * self.latency_scale)
+        return web.Response(
+            text=fixture["body"], status=fixture["status"], headers=fixture["headers"]
+        )
+
+    def report(self):
+        for (method, path), count in self.misses.most_common():
+            print("No fixture for %s %s (%d)" % (method, path, count), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record or replay Jamf Pro traffic")
+    parser.add_argument("mode", choices=("record", "replay"))
+    parser.add_argument("--fixtures", required=True)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--target")  # Jamf Pro url to record from
+    parser.add_argument("--do_not_verify_ssl", action="store_false")
+    parser.add_argument(
+        "--latency_scale", type=float, default=1.0
+    )  # 0 replays without delay, 2 at twice the recorded latency
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        if not args.target:
+            parser.error("record needs --target")
+        server = Recorder(args.target, args.fixtures, args.do_not_verify_ssl)
+    else:
+        server = Replayer(args.fixtures, args.latency_scale)
+    try:
+        web.run_app(server.app(), host="127.0.0.1", port=args.port)
+    finally:
+        if args.mode == "replay":
+            server.report()